@@ -0,0 +1,110 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Admission control for webhooks.
+
+A worker handles a limited number of webhooks at once. Further user
+messages wait in a short bounded queue, and anything else is shed
+straight away, so an overloaded worker answers quickly with a 503 that
+Business Messages redelivers later, instead of holding requests until
+gunicorn times them out.
+"""
+
+import threading
+import time
+
+from metrics import METRICS
+
+# Webhook priorities. Only high priority webhooks wait for a free slot.
+PRIORITY_HIGH = 'high'
+PRIORITY_LOW = 'low'
+
+class AdmissionController(object):
+    '''
+    Limits the webhooks in flight, queueing high priority ones for a while
+    and letting them in before any low priority ones.
+    '''
+
+    def __init__(self, max_in_flight, max_queued, queue_timeout_seconds):
+        '''
+        Args:
+            max_in_flight (int): The most webhooks handled at once.
+            max_queued (int): The most high priority webhooks waiting for
+                a slot.
+            queue_timeout_seconds (float): The longest a webhook waits for
+                a slot before it is shed.
+        '''
+        self._max_in_flight = max_in_flight
+        self._max_queued = max_queued
+        self._queue_timeout_seconds = queue_timeout_seconds
+        self._condition = threading.Condition(threading.Lock())
+        self._in_flight = 0
+        self._queued = 0
+
+        METRICS.register_gauge('bm_admission_in_flight', lambda: self._in_flight)
+        METRICS.register_gauge('bm_admission_queued', lambda: self._queued)
+
+    def acquire(self, priority):
+        '''
+        Takes a slot for a webhook, waiting for one if it is high priority.
+        A webhook that is admitted must be followed by release().
+
+        Args:
+            priority (str): PRIORITY_HIGH or PRIORITY_LOW.
+
+        Returns:
+           A :bool: True if the webhook was admitted, False if it is shed.
+        '''
+        with self._condition:
+            # Low priority webhooks never overtake queued ones
+            if self._in_flight < self._max_in_flight and not self._queued:
+                self._in_flight += 1
+                return True
+
+            if priority != PRIORITY_HIGH or self._queued >= self._max_queued:
+                return self._shed(priority, 'full')
+
+            self._queued += 1
+            deadline = time.monotonic() + self._queue_timeout_seconds
+
+            try:
+                while self._in_flight >= self._max_in_flight:
+                    remaining_seconds = deadline - time.monotonic()
+
+                    if remaining_seconds <= 0:
+                        return self._shed(priority, 'timeout')
+
+                    self._condition.wait(remaining_seconds)
+            finally:
+                self._queued -= 1
+
+            self._in_flight += 1
+
+            return True
+
+    def release(self):
+        '''
+        Frees the slot of a webhook that has been handled.
+        '''
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def _shed(self, priority, reason):
+        '''
+        Counts a webhook that is not admitted.
+        '''
+        METRICS.increment('bm_webhook_shed_total', labels={'priority': priority, 'reason': reason})
+
+        return False
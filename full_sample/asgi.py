@@ -0,0 +1,198 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""ASGI entry point for the webhook that sends replies with asyncio.
+
+This is an alternative to the Flask app in main.py for deployments that
+need many outbound calls in flight per process. It understands the same
+commands and reuses the reply builders, credentials, signature checks,
+dedup store, shutdown drain and metrics from main.py. Select it by changing
+the entrypoint in app.yaml to:
+
+    gunicorn -k uvicorn.workers.UvicornWorker -b :$PORT asgi:app
+
+Replies are sent once, without the retries, circuit breaker and rate limits
+of main.py; a reply that fails is left to the redelivery of its webhook.
+"""
+
+import asyncio
+import os
+
+from async_client import AsyncBusinessMessagesClient
+from events import EVENT_MESSAGE, EVENT_SECRET, EVENT_SUGGESTION_RESPONSE, parse_event
+
+import main
+
+# The most outbound API connections each worker keeps open at once
+ASYNC_MAX_CONNECTIONS = int(os.environ.get('BM_ASYNC_MAX_CONNECTIONS', '1000'))
+
+async def get_access_token():
+    '''
+    Returns the shared access token, refreshing it off the event loop if the
+    background refresher has fallen behind.
+
+    Returns:
+       A :str: A valid OAuth access token.
+    '''
+    credentials, _ = main.CLIENT_CACHE.get_credentials()
+
+    if not credentials.access_token or credentials.access_token_expired:
+        await asyncio.get_running_loop().run_in_executor(
+            None, main.TOKEN_REFRESHER.ensure_valid, credentials)
+
+    return credentials.access_token
+
+# The asyncio client shared by every request in this worker
+ASYNC_CLIENT = AsyncBusinessMessagesClient(
+    get_access_token, ASYNC_MAX_CONNECTIONS, main.HTTP_TIMEOUT_SECONDS)
+
+async def app(scope, receive, send):
+    '''
+    ASGI application serving /callback and /metrics.
+    '''
+    if scope['type'] == 'lifespan':
+        await handle_lifespan(receive, send)
+    elif scope['type'] == 'http':
+        if scope['path'] == '/callback' and scope['method'] == 'POST':
+            status, body, headers = await callback(
+                await read_body(receive, main.MAX_WEBHOOK_BYTES),
+                get_header(scope, b'x-goog-signature'))
+            await respond(send, status, body, b'text/html; charset=utf-8', headers)
+        elif scope['path'] == '/metrics' and scope['method'] == 'GET':
+            await respond(send, 200, main.METRICS.render().encode('utf-8'),
+                          b'text/plain; version=0.0.4')
+        else:
+            await respond(send, 404, b'', b'text/plain')
+
+async def handle_lifespan(receive, send):
+    '''
+    Opens the outbound connection pool on startup and closes it on shutdown.
+    '''
+    while True:
+        event = await receive()
+
+        if event['type'] == 'lifespan.startup':
+            main.TOKEN_REFRESHER.ensure_started()
+            await ASYNC_CLIENT.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif event['type'] == 'lifespan.shutdown':
+            await ASYNC_CLIENT.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def callback(raw_body, signature):
+    '''
+    Processes a message sent from the user, mirroring callback() in main.py
+    and the checks of the WebhookFilter in front of it.
+
+    Args:
+        raw_body (bytes): The webhook request body, or None if it was too
+            large.
+        signature (str): The x-goog-signature header, or None if it is
+            missing.
+
+    Returns:
+       A :tuple: The response status, body and any extra headers.
+    '''
+    if main.SHUTDOWN.draining:
+        # Let Business Messages redeliver the webhook to a worker that is not stopping
+        return 503, b'', [(b'retry-after', str(main.SHED_RETRY_AFTER_SECONDS).encode('ascii'))]
+
+    if raw_body is None:
+        main.METRICS.increment('bm_webhook_rejected_total', labels={'reason': 'too_large'})
+        return 413, b'', []
+
+    if main.SIGNATURE_VERIFIER is not None:
+        reason = main.SIGNATURE_VERIFIER.check(raw_body, signature)
+
+        if reason is not None:
+            main.METRICS.increment('bm_webhook_rejected_total', labels={'reason': reason})
+            return 403, b'', []
+
+    try:
+        event = parse_event(raw_body)
+    except ValueError:
+        return 400, b'Invalid webhook body', []
+
+    # To set a webhook, extract the secret from the request and return it
+    if event.kind == EVENT_SECRET:
+        return 200, event.secret.encode('utf-8'), []
+
+    # Drop webhooks that were redelivered after already being processed
+    dedup_key = event.dedup_key
+
+    if dedup_key is not None and not main.DEDUP_STORE.add(dedup_key):
+        main.METRICS.increment('bm_webhook_duplicates_dropped_total')
+        return 200, b'', []
+
+    if event.kind not in (EVENT_MESSAGE, EVENT_SUGGESTION_RESPONSE):
+        return 200, b'', []
+
+    try:
+        reply = main.build_reply(event.text, event.postback_data)
+        encoded_reply = main.REPLY_TEMPLATES.encode(reply)
+
+        await ASYNC_CLIENT.send_message(
+            reply if encoded_reply is None else encoded_reply,
+            event.conversation_id, main.BOT_REPRESENTATIVE)
+    except BaseException:
+        # Let the redelivery of a webhook that failed be processed again
+        if dedup_key is not None:
+            main.DEDUP_STORE.discard(dedup_key)
+        raise
+
+    return 200, b'', []
+
+async def read_body(receive, max_bytes):
+    '''
+    Reads the full request body, or returns None as soon as it is larger
+    than max_bytes.
+    '''
+    chunks = []
+    size = 0
+
+    while True:
+        event = await receive()
+        chunk = event.get('body', b'')
+        size += len(chunk)
+
+        if size > max_bytes:
+            return None
+
+        chunks.append(chunk)
+
+        if not event.get('more_body'):
+            return b''.join(chunks)
+
+def get_header(scope, name):
+    '''
+    Returns the value of a request header, or None if it is missing.
+    '''
+    for header_name, value in scope['headers']:
+        if header_name == name:
+            return value.decode('latin-1')
+
+    return None
+
+async def respond(send, status, body, content_type, headers=()):
+    '''
+    Sends a complete response.
+    '''
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type),
+                    (b'content-length', str(len(body)).encode('ascii'))] + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,146 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""asyncio client for the Business Messages conversations endpoints.
+
+Payloads are built with the same BusinessMessages* message classes as the
+apitools client and encoded with the apitools JSON encoder, but the HTTP
+calls are made with aiohttp so one process can keep thousands of sends in
+flight without a thread for each.
+"""
+
+import json
+import uuid
+
+import aiohttp
+
+from apitools.base.py import encoding
+from apitools.base.py import exceptions as apitools_exceptions
+from apitools.base.py import http_wrapper
+
+from businessmessages import businessmessages_v1_client as bm_client
+from businessmessages.businessmessages_v1_messages import BusinessMessagesEvent
+
+class AsyncBusinessMessagesClient(object):
+    '''
+    Sends messages and events to the Business Messages API with asyncio.
+    '''
+
+    def __init__(self, get_access_token, max_connections, timeout):
+        '''
+        Args:
+            get_access_token (callable): Coroutine function returning a valid
+                OAuth access token.
+            max_connections (int): The most connections kept open at once.
+            timeout (float): The total timeout of each API call in seconds.
+        '''
+        self._get_access_token = get_access_token
+        self._max_connections = max_connections
+        self._timeout = timeout
+        self._session = None
+
+    async def start(self):
+        '''
+        Opens the shared keep-alive connection pool. Must be called from the
+        event loop that will make the API calls.
+        '''
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self._max_connections),
+            timeout=aiohttp.ClientTimeout(total=self._timeout))
+
+    async def close(self):
+        '''
+        Closes the connection pool.
+        '''
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def create_message(self, message, conversation_id):
+        '''
+        Sends a message to the user.
+
+        Args:
+            message (obj): The BusinessMessagesMessage to send, or its JSON
+                encoding as bytes.
+            conversation_id (str): The unique id for this user and agent.
+
+        Returns:
+           A :dict: The decoded JSON response.
+        '''
+        return await self._post(
+            'v1/conversations/%s/messages' % conversation_id, message)
+
+    async def create_event(self, event, conversation_id):
+        '''
+        Sends an event, such as a typing indicator, to the user.
+
+        Args:
+            event (obj): The BusinessMessagesEvent to send.
+            conversation_id (str): The unique id for this user and agent.
+
+        Returns:
+           A :dict: The decoded JSON response.
+        '''
+        return await self._post(
+            'v1/conversations/%s/events' % conversation_id, event,
+            params={'eventId': str(uuid.uuid4().int)})
+
+    async def send_message(self, message, conversation_id, representative):
+        '''
+        Sends a message wrapped in typing started and typing stopped events,
+        matching the blocking send_message in main.py.
+
+        Args:
+            message (obj): The BusinessMessagesMessage to send, or its JSON
+                encoding as bytes.
+            conversation_id (str): The unique id for this user and agent.
+            representative (obj): The BusinessMessagesRepresentative to send as.
+        '''
+        await self.create_event(BusinessMessagesEvent(
+            representative=representative,
+            eventType=BusinessMessagesEvent.EventTypeValueValuesEnum.TYPING_STARTED
+        ), conversation_id)
+
+        await self.create_message(message, conversation_id)
+
+        await self.create_event(BusinessMessagesEvent(
+            representative=representative,
+            eventType=BusinessMessagesEvent.EventTypeValueValuesEnum.TYPING_STOPPED
+        ), conversation_id)
+
+    async def _post(self, path, payload, params=None):
+        '''
+        Posts a message object, encoding it unless it is already bytes, and
+        raises the same HttpError subclasses as apitools on a failed response.
+        '''
+        if not isinstance(payload, bytes):
+            payload = encoding.MessageToJson(payload)
+
+        url = bm_client.BusinessmessagesV1.BASE_URL + path
+        headers = {
+            'Authorization': 'Bearer ' + await self._get_access_token(),
+            'Content-Type': 'application/json',
+        }
+
+        async with self._session.post(url, data=payload,
+                                      headers=headers, params=params) as response:
+            content = await response.text()
+
+            if response.status >= 300:
+                info = dict(response.headers, status=str(response.status))
+                raise apitools_exceptions.HttpError.FromResponse(
+                    http_wrapper.Response(info, content, url))
+
+            return json.loads(content) if content else {}
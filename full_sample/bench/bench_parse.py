@@ -0,0 +1,104 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the time and memory to parse and classify a webhook.
+
+Times the original callback's handling of a typical message webhook, which
+decoded it, encoded it again for a debug log and walked the dicts, against
+parse_event() with the standard json module and with orjson, when it is
+installed.
+
+Run with: python bench/bench_parse.py
+"""
+
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from events import orjson, parse_event  # pylint: disable=wrong-import-position
+
+# The calls timed per measurement
+NUMBER = 50000
+
+# A message webhook as sent by Business Messages
+BODY = json.dumps({
+    'agent': 'brands/1234/agents/5678',
+    'conversationId': '0bd4b5a1-2f6e-4a5b-9c3d-1e2f3a4b5c6d',
+    'customAgentId': '',
+    'requestId': 'f1e2d3c4-b5a6-4978-8a9b-0c1d2e3f4a5b',
+    'message': {
+        'messageId': 'a1b2c3d4-e5f6-4a7b-8c9d-0e1f2a3b4c5d',
+        'name': 'conversations/0bd4b5a1/messages/a1b2c3d4',
+        'text': 'Hello there, can you show me a card please?',
+        'createTime': '2020-10-17T01:02:03.456Z',
+    },
+    'context': {
+        'placeId': '',
+        'entryPoint': 'PLACESHEET',
+        'userInfo': {'displayName': 'Jo', 'userDeviceLocale': 'en-US'},
+    },
+    'sendTime': '2020-10-17T01:02:03.789Z',
+}).encode('utf-8')
+
+def parse_original(body):
+    '''
+    The parsing parse_event replaced.
+    '''
+    request_body = json.loads(body)
+    json.dumps(request_body)
+
+    if 'secret' in request_body:
+        return request_body.get('secret')
+
+    conversation_id = request_body['conversationId']
+
+    if 'message' in request_body and 'text' in request_body['message']:
+        return request_body['message']['text'], conversation_id
+
+    return None
+
+def peak_bytes(parse):
+    '''
+    Returns the most memory allocated at once while parsing the body.
+    '''
+    parse(BODY)
+    tracemalloc.start()
+    parse(BODY)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return peak
+
+def main():
+    parsers = [
+        ('original', parse_original),
+        ('parse_event with json', lambda body: parse_event(body, json.loads)),
+    ]
+
+    if orjson is not None:
+        parsers.append(('parse_event with orjson', parse_event))
+
+    print('%d byte message webhook' % len(BODY))
+    print('%-24s %10s %11s' % ('parser', 'us/webhook', 'peak bytes'))
+
+    for name, parse in parsers:
+        seconds = min(timeit.repeat(lambda: parse(BODY), number=NUMBER, repeat=3)) / NUMBER
+        print('%-24s %10.2f %11d' % (name, seconds * 1e6, peak_bytes(parse)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the cost of routing a message against the number of commands.
+
+Registers n commands, each with an alias, a prefix and a keyword, and times
+CommandRouter.route() for an exact match, a prefix match, a keyword match
+and a message that matches nothing. The worst case of the if/elif chain
+that the router replaced is timed for comparison.
+
+Run with: python bench/bench_router.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from commands import CommandRouter  # pylint: disable=wrong-import-position
+
+# The numbers of registered commands to time
+COMMAND_COUNTS = (3, 100, 1000, 10000)
+
+# The calls timed per measurement
+NUMBER = 20000
+
+def build_router(names):
+    '''
+    Returns a router with a command for each name.
+    '''
+    router = CommandRouter()
+
+    for name in names:
+        router.command(name, aliases=[name + ' alias'], prefixes=[name + ' go'],
+                       keywords=[name + 'x'])(lambda message: None)
+
+    router.fallback('echo')(lambda message: None)
+
+    return router
+
+def build_chain(names):
+    '''
+    Returns the if/elif chain the router replaced, as a loop over the names.
+    '''
+    def route(message):
+        normalized_message = message.lower()
+
+        for name in names:
+            if normalized_message == name:
+                return name
+
+        return 'echo'
+
+    return route
+
+def time_call(func, *args):
+    '''
+    Returns the best time of a call in microseconds.
+    '''
+    return min(timeit.repeat(lambda: func(*args), number=NUMBER, repeat=3)) / NUMBER * 1e6
+
+def main():
+    print('%8s %8s %8s %8s %8s %8s' % (
+        'commands', 'exact', 'prefix', 'keyword', 'miss', 'chain'))
+
+    for count in COMMAND_COUNTS:
+        names = ['command%d' % i for i in range(count)]
+        router = build_router(names)
+        last = names[-1]
+
+        print('%8d %8.2f %8.2f %8.2f %8.2f %8.2f' % (
+            count,
+            time_call(router.route, last.upper()),
+            time_call(router.route, last + ' go somewhere'),
+            time_call(router.route, 'please ' + last + 'x now'),
+            time_call(router.route, 'hello there, how are you today?'),
+            time_call(build_chain(names), last)))
+
+    print('Times in microseconds per message')
+
+if __name__ == '__main__':
+    main()
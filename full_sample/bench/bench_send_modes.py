@@ -0,0 +1,61 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the wall-clock time per reply of the send modes.
+
+Each reply is routed and sent to a local stub API that takes a fixed time
+per call, in the sequential, batch and overlap modes of BM_SEND_MODE.
+
+Run with: python bench/bench_send_modes.py [--delay-ms 30] [--replies 20]
+"""
+
+import argparse
+import time
+
+from stub_api import StubApi, import_main
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--delay-ms', type=float, default=30,
+                        help='How long the stub takes per API call.')
+    parser.add_argument('--replies', type=int, default=20,
+                        help='The replies sent per mode and command.')
+    args = parser.parse_args()
+
+    stub = StubApi()
+    bot = import_main(stub)
+    # Fetch the access token before timing anything
+    bot.get_client()
+    stub.delay_seconds = args.delay_ms / 1000
+
+    print('%-10s %-9s %9s %14s' % ('mode', 'command', 'ms/reply', 'requests/reply'))
+
+    for mode in (bot.SEND_MODE_SEQUENTIAL, bot.SEND_MODE_BATCH, bot.SEND_MODE_OVERLAP):
+        bot.SEND_MODE = mode
+
+        for command in ('hi', bot.CMD_CAROUSEL_CARD):
+            bot.route_message(command, 'bench-conversation')
+            requests_before = stub.requests
+            start_time = time.perf_counter()
+
+            for _ in range(args.replies):
+                bot.route_message(command, 'bench-conversation')
+
+            elapsed = time.perf_counter() - start_time
+            print('%-10s %-9s %9.1f %14.1f' % (
+                mode, command, elapsed / args.replies * 1000,
+                float(stub.requests - requests_before) / args.replies))
+
+if __name__ == '__main__':
+    main()
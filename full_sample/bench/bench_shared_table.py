@@ -0,0 +1,103 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures SharedTable operations per second under multi-process contention.
+
+Several processes map the same table and add and count overlapping keys at
+once, as gunicorn workers do for dedup and rate accounting. The benchmark
+first checks that processes racing to add the same keys see exactly one
+winner per key.
+
+Run with: python bench/bench_shared_table.py [--operations 50000]
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared_table import SharedTable  # pylint: disable=wrong-import-position
+
+# The slots in the table and the distinct keys used
+NUM_SLOTS = 65536
+NUM_KEYS = 20000
+
+def race(path, worker, num_keys, results):  # pylint: disable=unused-argument
+    '''
+    Adds the same keys as the other racing processes, reporting how many
+    adds it won.
+    '''
+    table = SharedTable(path, NUM_SLOTS)
+    results.put(sum(table.add('race-%d' % key, 60) for key in range(num_keys)))
+
+def run(path, worker, operations, results):
+    '''
+    Adds and counts keys, reporting the operations per second.
+    '''
+    table = SharedTable(path, NUM_SLOTS)
+    start_time = time.perf_counter()
+
+    for i in range(operations):
+        key = 'key-%d' % ((i * 7919 + worker) % NUM_KEYS)
+
+        if i % 2:
+            table.increment(key, 1, 60)
+        else:
+            table.add(key, 60)
+
+    results.put(operations / (time.perf_counter() - start_time))
+
+def start_processes(target, count, path, argument):
+    '''
+    Runs target in count processes and returns what each one reported.
+    '''
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=target, args=(path, i, argument, results))
+                 for i in range(count)]
+
+    for process in processes:
+        process.start()
+
+    reported = [results.get() for _ in processes]
+
+    for process in processes:
+        process.join()
+
+    return reported
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--operations', type=int, default=50000,
+                        help='The operations made by each process.')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'shared-table')
+
+    winners = sum(start_processes(race, 4, path, 2000))
+    print('4 processes racing for 2000 keys: %d winners' % winners)
+
+    print('%9s %14s %14s' % ('processes', 'ops/s', 'ops/s/process'))
+
+    for count in (1, 2, 4, 8):
+        rates = start_processes(run, count, path, args.operations)
+        print('%9d %14.0f %14.0f' % (count, sum(rates), sum(rates) / count))
+
+    print('%d CPUs' % os.cpu_count())
+
+if __name__ == '__main__':
+    main()
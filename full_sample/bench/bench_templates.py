@@ -0,0 +1,73 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares building each static reply from scratch with copying its
+template.
+
+For the card, carousel and chips commands, times the builder that
+REPLY_TEMPLATES calls once against REPLY_TEMPLATES.get(), and measures the
+memory each reply allocates with tracemalloc.
+
+Run with: python bench/bench_templates.py [--replies 2000]
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from stub_api import StubApi, import_main
+
+def measure(build, replies):
+    '''
+    Returns the microseconds per reply and the bytes allocated per reply.
+    '''
+    build()
+    start_time = time.perf_counter()
+
+    for _ in range(replies):
+        build()
+
+    elapsed = time.perf_counter() - start_time
+
+    tracemalloc.start()
+    kept = [build() for _ in range(100)]
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+
+    return elapsed / replies * 1e6, allocated / 100
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--replies', type=int, default=2000,
+                        help='The replies built per command and method.')
+    args = parser.parse_args()
+
+    bot = import_main(StubApi())
+    builders = {
+        bot.CMD_RICH_CARD: bot.build_rich_card,
+        bot.CMD_CAROUSEL_CARD: bot.build_carousel,
+        bot.CMD_SUGGESTIONS: bot.build_message_with_suggestions,
+    }
+
+    print('%-9s %-9s %10s %12s' % ('command', 'method', 'us/reply', 'bytes/reply'))
+
+    for command, builder in builders.items():
+        for method, build in (('build', builder),
+                              ('template', lambda name=command: bot.REPLY_TEMPLATES.get(name))):
+            micros, allocated = measure(build, args.replies)
+            print('%-9s %-9s %10.1f %12d' % (command, method, micros, allocated))
+
+if __name__ == '__main__':
+    main()
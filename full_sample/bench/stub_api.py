@@ -0,0 +1,182 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local stub of the Business Messages API for the benchmarks.
+
+The stub answers the token endpoint, messages, events and batch requests
+with a configurable delay, so the bot can be timed without network access
+or real credentials. import_main() points main.py at the stub with a
+throwaway service account and imports it.
+"""
+
+import email.parser
+import http.server
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+
+import rsa
+
+# The directory holding main.py
+SAMPLE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class _StubHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Answers the API calls made by the bot after the stub's delay.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super(_StubHandler, self).setup()
+        # Send each small response without waiting for a delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers.get('content-length') or 0))
+
+        if self.path.startswith('/token'):
+            self._respond('application/json', json.dumps(
+                {'access_token': 'stub-token', 'expires_in': 3600}).encode('utf-8'))
+            return
+
+        self.server.stub.wait()
+        self.server.stub.requests += 1
+
+        if self.path.startswith('/batch'):
+            self._respond_to_batch(body)
+        elif '/events' in self.path or '/messages' in self.path:
+            self.server.stub.count(self.path)
+            self._respond('application/json', body)
+        else:
+            self._respond('text/plain', b'', status=404)
+
+    def _respond_to_batch(self, body):
+        '''
+        Echoes every part of a multipart batch request.
+        '''
+        content_type = self.headers['content-type']
+        batch = email.parser.Parser().parsestr(
+            'content-type: %s\r\n\r\n%s' % (content_type, body.decode('utf-8')))
+        parts = []
+
+        for part in batch.get_payload():
+            request_line, request = part.get_payload().split('\n', 1)
+            self.server.stub.count(request_line.split()[1])
+            parts.append(
+                '--stub\r\nContent-Type: application/http\r\n'
+                'Content-ID: <response-%s>\r\n\r\n'
+                'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n%s\r\n'
+                % (part['Content-ID'][1:-1], email.parser.Parser().parsestr(request).get_payload()))
+
+        self.server.stub.batches += 1
+        self._respond('multipart/mixed; boundary=stub',
+                      (''.join(parts) + '--stub--\r\n').encode('utf-8'))
+
+    def _respond(self, content_type, body, status=200):
+        self.send_response(status)
+        self.send_header('content-type', content_type)
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+class StubApi(object):
+    '''
+    Runs the stub on a free local port in a background thread.
+    '''
+
+    def __init__(self, delay_seconds=0):
+        '''
+        Args:
+            delay_seconds (float): How long each API call takes.
+        '''
+        self.delay_seconds = delay_seconds
+        self.requests = 0
+        self.messages = 0
+        self.events = 0
+        self.batches = 0
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/' % self._server.server_address[1]
+
+    def wait(self):
+        '''
+        Holds an API call for the stub's delay.
+        '''
+        if self.delay_seconds:
+            threading.Event().wait(self.delay_seconds)
+
+    def count(self, path):
+        '''
+        Counts a message or event received.
+        '''
+        with self._lock:
+            if '/messages' in path:
+                self.messages += 1
+            else:
+                self.events += 1
+
+def import_main(stub, **environ):
+    '''
+    Imports main.py with a throwaway service account that gets its tokens
+    from the stub, and sends every API call to the stub.
+
+    Args:
+        stub (obj): The StubApi to send to.
+        **environ: BM_* environment variables to set before the import.
+
+    Returns:
+       A :obj: The main module.
+    '''
+    _, private_key = rsa.newkeys(1024)
+
+    work_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(work_dir, 'resources'))
+
+    with open(os.path.join(work_dir, 'resources',
+                           'bm-agent-service-account-credentials.json'), 'w') as f:
+        json.dump({
+            'type': 'service_account',
+            'client_email': 'bench@example.iam.gserviceaccount.com',
+            'client_id': '1',
+            'private_key_id': 'bench',
+            'private_key': private_key.save_pkcs1().decode('ascii'),
+            'token_uri': stub.url + 'token',
+        }, f)
+
+    os.environ.setdefault('BM_SHARED_TABLE_PATH', os.path.join(work_dir, 'shared-table'))
+    os.environ.setdefault('BM_OUTBOX_PATH', os.path.join(work_dir, 'outbox.db'))
+    os.environ.setdefault('BM_ACCESS_LOG', 'false')
+    os.environ.setdefault('BM_PROFILE', 'prod')
+    os.environ.update(environ)
+    os.chdir(work_dir)
+
+    if SAMPLE_DIR not in sys.path:
+        sys.path.insert(0, SAMPLE_DIR)
+
+    from businessmessages import businessmessages_v1_client as bm_client
+    bm_client.BusinessmessagesV1.BASE_URL = stub.url
+
+    import main
+
+    return main
@@ -0,0 +1,206 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Registry mapping the text of incoming messages to the commands that reply.
+
+Commands register themselves with a decorator, so adding one does not
+mean touching the routing code:
+
+    @COMMANDS.command('card', aliases=['rich card'], prefixes=['show card'],
+                      keywords=['cards'])
+    def card_reply(message):
+        return build_rich_card()
+
+A suggestion response is first looked up by its postbackData, skipping text
+matching altogether. Any other message, or a suggestion response with an
+unknown postbackData, is matched, after trimming and lowercasing, by:
+1. its whole text against every command name and alias, with one dict lookup
+2. its leading words against every prefix, by walking a trie once
+3. any of its words against every keyword, by walking a second trie from
+   the start of each word, so the first keyword in the text wins
+4. otherwise the fallback handler
+"""
+
+# Trie key marking the end of a prefix; never a single character
+_END = ''
+
+class CommandRouter(object):
+    '''
+    Routes messages to registered command handlers. A handler receives the
+    message text and returns the reply to send.
+    '''
+
+    def __init__(self):
+        self._exact = {}
+        self._trie = {}
+        self._keyword_trie = {}
+        self._postbacks = {}
+        self._fallback = None
+
+    def command(self, name, aliases=(), prefixes=(), keywords=(), postbacks=()):
+        '''
+        Returns a decorator registering a command handler.
+
+        Args:
+            name (str): The command name, which also matches as message text.
+            aliases (list): Other message texts that select the command.
+            prefixes (list): Leading words that select the command whatever
+                follows them, e.g. 'weather' matches 'weather in Paris'.
+            keywords (list): Words that select the command wherever they
+                appear, e.g. 'price' matches 'what is the price'.
+            postbacks (list): The postbackData of suggestions that select
+                the command when tapped.
+
+        Returns:
+           A :obj: The decorator, which returns the handler unchanged.
+        '''
+        def register(handler):
+            for text in [name] + list(aliases):
+                key = normalize(text)
+
+                if key in self._exact:
+                    raise ValueError('%r is already registered to %s'
+                                     % (text, self._exact[key][0]))
+
+                self._exact[key] = (name, handler)
+
+            for prefix in prefixes:
+                _insert(self._trie, prefix, 'Prefix', name, handler)
+
+            for keyword in keywords:
+                _insert(self._keyword_trie, keyword, 'Keyword', name, handler)
+
+            self._register_postbacks(postbacks, name, handler)
+
+            return handler
+
+        return register
+
+    def fallback(self, name, postbacks=()):
+        '''
+        Returns a decorator registering the handler for messages that match
+        no command.
+
+        Args:
+            name (str): The name reported for messages that match no command.
+            postbacks (list): The postbackData of suggestions that are
+                handled by the fallback when tapped.
+
+        Returns:
+           A :obj: The decorator, which returns the handler unchanged.
+        '''
+        def register(handler):
+            self._fallback = (name, handler)
+            self._register_postbacks(postbacks, name, handler)
+
+            return handler
+
+        return register
+
+    def route(self, message, postback_data=None):
+        '''
+        Finds the command a message asks for.
+
+        Args:
+            message (str): The message text received from the user.
+            postback_data (str): The postbackData of the suggestion the user
+                tapped, if any.
+
+        Returns:
+           A :tuple: The command name and its handler.
+        '''
+        if postback_data is not None:
+            match = self._postbacks.get(postback_data)
+
+            if match is not None:
+                return match
+
+        text = normalize(message)
+        match = self._exact.get(text)
+
+        if match is not None:
+            return match
+
+        match = _find_longest(self._trie, text, 0)
+
+        if match is not None:
+            return match
+
+        if self._keyword_trie:
+            for index, char in enumerate(text):
+                if char.isspace() or (index and not text[index - 1].isspace()):
+                    continue
+
+                match = _find_longest(self._keyword_trie, text, index)
+
+                if match is not None:
+                    return match
+
+        return self._fallback
+
+    def _register_postbacks(self, postbacks, name, handler):
+        '''
+        Maps postbackData values straight to a handler.
+        '''
+        for postback_data in postbacks:
+            if postback_data in self._postbacks:
+                raise ValueError('Postback %r is already registered to %s'
+                                 % (postback_data, self._postbacks[postback_data][0]))
+
+            self._postbacks[postback_data] = (name, handler)
+
+def _insert(trie, text, kind, name, handler):
+    '''
+    Adds a prefix or keyword to a trie.
+    '''
+    node = trie
+
+    for char in normalize(text):
+        node = node.setdefault(char, {})
+
+    if _END in node:
+        raise ValueError('%s %r is already registered to %s' % (kind, text, node[_END][0]))
+
+    node[_END] = (name, handler)
+
+def _find_longest(trie, text, start):
+    '''
+    Walks a trie along the text from start, returning the command of the
+    longest entry that ends on a word boundary, or None.
+    '''
+    match = None
+    node = trie
+
+    for index in range(start, len(text)):
+        node = node.get(text[index])
+
+        if node is None:
+            break
+
+        if _END in node and (index + 1 == len(text) or text[index + 1].isspace()):
+            match = node[_END]
+
+    return match
+
+def normalize(message):
+    '''
+    Normalizes message text for matching.
+
+    Args:
+        message (str): The message text received from the user.
+
+    Returns:
+       A :str: The trimmed, lowercased text.
+    '''
+    return message.strip().lower()
@@ -0,0 +1,89 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stores used to drop webhooks that Business Messages delivers more than once.
+
+A store only needs two methods, so it can be backed by anything that is
+shared between instances:
+
+    add(key) - Records the key. Returns False if it was already recorded
+        and has not expired, True otherwise.
+    discard(key) - Forgets the key, so a redelivery is processed again.
+"""
+
+import collections
+import threading
+import time
+
+class InMemoryDedupStore(object):
+    '''
+    A per-process store of recently seen keys, bounded by both age and size.
+    The least recently added keys are evicted first.
+    '''
+
+    def __init__(self, max_entries, ttl_seconds):
+        '''
+        Args:
+            max_entries (int): The most keys to remember.
+            ttl_seconds (float): How long each key is remembered.
+        '''
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        '''
+        Records a key unless it was already seen.
+
+        Args:
+            key (str): The key to record.
+
+        Returns:
+           A :bool: False if the key was seen within the TTL, True otherwise.
+        '''
+        now = time.time()
+
+        with self._lock:
+            # Keys are kept in insertion order, so expired ones are at the front
+            while self._entries:
+                oldest_key, expiry = next(iter(self._entries.items()))
+
+                if expiry > now:
+                    break
+
+                del self._entries[oldest_key]
+
+            if key in self._entries:
+                return False
+
+            self._entries[key] = now + self._ttl_seconds
+
+            if len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+            return True
+
+    def discard(self, key):
+        '''
+        Forgets a key.
+
+        Args:
+            key (str): The key to forget.
+        '''
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,174 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Background worker pool used to send replies after a webhook is acknowledged.
+
+Work is sharded across lanes by conversation id. Each lane is a FIFO queue
+served by a single thread, so replies within a conversation are sent in the
+order their messages arrived while different conversations are sent in
+parallel. The number of lanes is fixed, so idle conversations cost nothing.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
+
+from metrics import METRICS
+
+class SendQueueFullError(Exception):
+    '''
+    Raised when a reply cannot be queued because its lane stayed full.
+    '''
+
+class SendWorkerPool(object):
+    '''
+    A bounded pool of worker threads that runs reply sends off the request
+    thread, so the webhook can be acknowledged as soon as it is queued.
+    '''
+
+    def __init__(self, num_workers, queue_size, put_timeout):
+        '''
+        Args:
+            num_workers (int): The number of lanes, each with one worker thread.
+            queue_size (int): The most tasks that may wait across all lanes.
+            put_timeout (float): How long to wait for room in a full lane.
+        '''
+        self._num_workers = num_workers
+        self._put_timeout = put_timeout
+        self._lanes = [queue.Queue(max(queue_size // num_workers, 1))
+                       for _ in range(num_workers)]
+        self._lock = threading.Lock()
+        self._pid = None
+        self._busy_workers = 0
+        self._pending = 0
+
+        METRICS.register_gauge('bm_send_queue_depth', lambda: self.queued())
+        METRICS.register_gauge('bm_send_workers_busy', lambda: self._busy_workers)
+        METRICS.register_gauge('bm_send_worker_utilization',
+                               lambda: float(self._busy_workers) / self._num_workers)
+
+    def submit(self, key, func, *args):
+        '''
+        Queues a function on the lane for the given key. Tasks with the same
+        key run one at a time in submission order.
+
+        Args:
+            key (str): The ordering key, usually the conversation id.
+            func (callable): The function to call.
+            *args: The arguments to call it with.
+
+        Returns:
+           A :bool: True if the task was queued, False if its lane stayed full.
+        '''
+        self._ensure_started()
+
+        lane = self._lanes[zlib.crc32(key.encode('utf-8')) % self._num_workers]
+
+        with self._lock:
+            self._pending += 1
+
+        try:
+            lane.put((time.time(), func, args), timeout=self._put_timeout)
+        except queue.Full:
+            with self._lock:
+                self._pending -= 1
+
+            METRICS.increment('bm_send_queue_full_total')
+            return False
+
+        return True
+
+    def pending(self):
+        '''
+        Returns the number of tasks that are queued or running.
+
+        Returns:
+           A :int: The number of unfinished tasks.
+        '''
+        return self._pending
+
+    def queued(self):
+        '''
+        Returns the number of tasks waiting for a worker thread.
+
+        Returns:
+           A :int: The number of queued tasks.
+        '''
+        return sum(lane.qsize() for lane in self._lanes)
+
+    def discard_queued(self):
+        '''
+        Removes the tasks that are still waiting for a worker thread.
+
+        Returns:
+           A :int: The number of tasks removed.
+        '''
+        discarded = 0
+
+        for lane in self._lanes:
+            while True:
+                try:
+                    lane.get_nowait()
+                except queue.Empty:
+                    break
+
+                discarded += 1
+
+        with self._lock:
+            self._pending -= discarded
+
+        return discarded
+
+    def _ensure_started(self):
+        '''
+        Starts the worker threads unless they are already running in this
+        process. Threads do not survive a fork, so this is checked per pid.
+        '''
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+
+                for i, lane in enumerate(self._lanes):
+                    threading.Thread(target=self._run, args=(lane,),
+                                     name='send-worker-%d' % i, daemon=True).start()
+
+    def _run(self, lane):
+        '''
+        Runs the tasks queued on a lane, in order, until the process exits.
+
+        Args:
+            lane (obj): The queue this worker serves.
+        '''
+        while True:
+            enqueue_time, func, args = lane.get()
+            METRICS.observe('bm_send_queue_wait_seconds', time.time() - enqueue_time)
+
+            with self._lock:
+                self._busy_workers += 1
+
+            try:
+                func(*args)
+            except Exception:  # pylint: disable=broad-except
+                METRICS.increment('bm_send_task_failures_total')
+                logging.getLogger(__name__).exception('Failed to send reply')
+            finally:
+                with self._lock:
+                    self._busy_workers -= 1
+                    self._pending -= 1
@@ -0,0 +1,164 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Parses webhook bodies into compact event objects.
+
+The body is decoded once, with orjson when it is installed and the
+standard json module otherwise, and the fields the bot uses are copied
+into a WebhookEvent. Handlers read those attributes instead of walking
+the decoded dicts again.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The kinds of webhook the bot tells apart
+EVENT_SECRET = 'secret'
+EVENT_MESSAGE = 'message'
+EVENT_SUGGESTION_RESPONSE = 'suggestionResponse'
+EVENT_USER_STATUS = 'userStatus'
+EVENT_OTHER = 'other'
+
+# Decodes a JSON document from bytes
+decode_json = orjson.loads if orjson is not None else json.loads
+
+class WebhookEvent(object):
+    '''
+    The fields of a webhook that the bot acts on.
+    '''
+
+    __slots__ = ('kind', 'conversation_id', 'dedup_key', 'text', 'postback_data',
+                 'secret', 'is_typing', 'requested_live_agent')
+
+    def __init__(self, kind, conversation_id=None, dedup_key=None, text=None,
+                 postback_data=None, secret=None, is_typing=False,
+                 requested_live_agent=False):
+        '''
+        Args:
+            kind (str): One of the EVENT_* constants.
+            conversation_id (str): The unique id for this user and agent.
+            dedup_key (str): The id that stays the same when the webhook is
+                redelivered: the requestId, else the user's message id.
+            text (str): The message or suggestion text sent by the user.
+            postback_data (str): The postbackData of the tapped suggestion.
+            secret (str): The secret of a webhook verification request.
+            is_typing (bool): Whether the user status says they are typing.
+            requested_live_agent (bool): Whether the user asked for a person.
+        '''
+        self.kind = kind
+        self.conversation_id = conversation_id
+        self.dedup_key = dedup_key
+        self.text = text
+        self.postback_data = postback_data
+        self.secret = secret
+        self.is_typing = is_typing
+        self.requested_live_agent = requested_live_agent
+
+def parse_event(body, loads=None):
+    '''
+    Decodes a webhook body and classifies it.
+
+    Args:
+        body (bytes): The raw webhook request body.
+        loads (callable): Decodes JSON bytes; defaults to decode_json.
+
+    Returns:
+       A :obj: A WebhookEvent.
+
+    Raises:
+        ValueError: If the body is not a JSON object, a field the bot uses
+            has the wrong type, or an event to reply to has no conversationId.
+    '''
+    request_body = (loads or decode_json)(body)
+
+    if not isinstance(request_body, dict):
+        raise ValueError('Webhook body is not a JSON object')
+
+    # To set a webhook, the secret is extracted from the request and returned
+    secret = _get_string(request_body, 'secret')
+
+    if secret is not None:
+        return WebhookEvent(EVENT_SECRET, secret=secret)
+
+    conversation_id = _get_string(request_body, 'conversationId')
+    dedup_key = _get_string(request_body, 'requestId')
+    message = _get_object(request_body, 'message')
+
+    if message is not None:
+        if dedup_key is None:
+            dedup_key = _get_string(message, 'messageId')
+
+        text = _get_string(message, 'text')
+
+        if text is not None:
+            if conversation_id is None:
+                raise ValueError('Message has no conversationId to reply to')
+
+            return WebhookEvent(EVENT_MESSAGE, conversation_id, dedup_key, text=text)
+
+    suggestion_response = _get_object(request_body, 'suggestionResponse')
+
+    if suggestion_response is not None:
+        text = _get_string(suggestion_response, 'text')
+
+        if text is None:
+            raise ValueError('Suggestion response has no text')
+
+        if conversation_id is None:
+            raise ValueError('Suggestion response has no conversationId to reply to')
+
+        return WebhookEvent(EVENT_SUGGESTION_RESPONSE, conversation_id, dedup_key,
+                            text=text,
+                            postback_data=_get_string(suggestion_response, 'postbackData'))
+
+    user_status = _get_object(request_body, 'userStatus')
+
+    if user_status is not None:
+        return WebhookEvent(EVENT_USER_STATUS, conversation_id, dedup_key,
+                            is_typing='isTyping' in user_status,
+                            requested_live_agent='requestedLiveAgent' in user_status)
+
+    return WebhookEvent(EVENT_OTHER, conversation_id, dedup_key)
+
+def _get_object(parent, key):
+    '''
+    Returns a nested JSON object, or None if it is missing.
+
+    Raises:
+        ValueError: If the value is not a JSON object.
+    '''
+    value = parent.get(key)
+
+    if value is not None and not isinstance(value, dict):
+        raise ValueError('%s is not a JSON object' % key)
+
+    return value
+
+def _get_string(parent, key):
+    '''
+    Returns a string field, or None if it is missing.
+
+    Raises:
+        ValueError: If the value is not a string.
+    '''
+    value = parent.get(key)
+
+    if value is not None and not isinstance(value, str):
+        raise ValueError('%s is not a string' % key)
+
+    return value
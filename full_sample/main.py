@@ -24,13 +24,32 @@ Any other incoming message is echoed back to the end-user.
 """
 
 # [START app]
+import concurrent.futures
+import contextlib
+import datetime
+import itertools
 import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
 import uuid
 
+import httplib2
+
 from oauth2client.service_account import ServiceAccountCredentials
 
+from apitools.base.py import batch
+from apitools.base.py import encoding
+from apitools.base.py import exceptions as apitools_exceptions
+from apitools.base.py import http_wrapper
+
 from flask import Flask
+from flask import g
 from flask import request
+from flask.logging import default_handler
 
 from businessmessages import businessmessages_v1_client as bm_client
 from businessmessages.businessmessages_v1_messages import (
@@ -41,14 +60,210 @@ from businessmessages.businessmessages_v1_messages import (
     BusinessMessagesRepresentative, BusinessMessagesRichCard, BusinessMessagesStandaloneCard,
     BusinessMessagesSuggestion, BusinessMessagesSuggestedAction, BusinessMessagesSuggestedReply)
 
+from admission import AdmissionController
+from commands import CommandRouter
+from dedup import InMemoryDedupStore
+from dispatcher import SendQueueFullError, SendWorkerPool
+from events import EVENT_MESSAGE, EVENT_SECRET, EVENT_SUGGESTION_RESPONSE
+from events import EVENT_USER_STATUS, parse_event
+from metrics import METRICS
+from middleware import SignatureVerifier, WebhookFilter
+from outbox import Outbox
+from profiling import RequestProfiler
+from ratelimit import OutboundRateLimiter, ThrottledError
+from request_log import AsyncLogHandler, LogFormatter
+import request_log
+from resilience import CIRCUIT_CLOSED, CircuitBreaker, CircuitOpenError, RetryBudget
+from resilience import RetryPolicy
+from shared_table import SharedDedupStore, SharedTable
+from shutdown import ShutdownCoordinator
+from transport import HttpConnectionPool, PoolTimeoutError, PooledHttp
+
+# How the app runs:
+# - dev - Flask debug mode, every webhook body and debug messages logged as text
+# - prod - No debug mode, sampled webhook bodies and INFO messages logged as JSON
+PROFILE_DEV = 'dev'
+PROFILE_PROD = 'prod'
+PROFILE = os.environ.get('BM_PROFILE', PROFILE_DEV).lower()
+
+# Log the body of one in this many webhooks, and of every webhook that fails.
+# 0 only logs the bodies of webhooks that fail.
+LOG_PAYLOAD_EVERY = int(os.environ.get('BM_LOG_PAYLOAD_EVERY',
+                                       '1' if PROFILE == PROFILE_DEV else '0'))
+
+# Write a one-line access log with stage timings for each webhook
+ACCESS_LOG = os.environ.get('BM_ACCESS_LOG', 'true').lower() == 'true'
+
+# The most log records waiting to be written before new ones are dropped
+LOG_QUEUE_SIZE = 10000
+
+# Profile one in this many webhooks; 0 only profiles webhooks sent with the
+# admin token
+PROFILER_SAMPLE_EVERY = int(os.environ.get('BM_PROFILER_SAMPLE_EVERY', '0'))
+
+# The token that forces a webhook to be profiled when sent in the
+# ADMIN_TOKEN_HEADER, and that is required to read the results
+ADMIN_TOKEN = os.environ.get('BM_ADMIN_TOKEN')
+ADMIN_TOKEN_HEADER = 'X-Admin-Token'
+
+# How often the call stacks of profiled webhooks are sampled
+PROFILER_SAMPLE_INTERVAL_SECONDS = 0.005
+
 # The location of the service account credentials
 SERVICE_ACCOUNT_LOCATION = 'resources/bm-agent-service-account-credentials.json'
 
+# The OAuth scope required to call the Business Messages API
+BM_API_SCOPES = ['https://www.googleapis.com/auth/businessmessages']
+
+# The most outbound API connections each worker keeps open at once
+HTTP_POOL_SIZE = int(os.environ.get('BM_HTTP_POOL_SIZE', '10'))
+
+# Timeout for outbound API calls and for waiting on a pooled connection
+HTTP_TIMEOUT_SECONDS = float(os.environ.get('BM_HTTP_TIMEOUT_SECONDS', '30'))
+
+# The most attempts at each outbound message, and the longest waits before
+# the first and any later retry. Each wait is a random time up to the backoff.
+RETRY_MAX_ATTEMPTS = int(os.environ.get('BM_RETRY_MAX_ATTEMPTS', '3'))
+RETRY_BASE_DELAY_SECONDS = float(os.environ.get('BM_RETRY_BASE_DELAY_MS', '100')) / 1000
+RETRY_MAX_DELAY_SECONDS = float(os.environ.get('BM_RETRY_MAX_DELAY_MS', '2000')) / 1000
+
+# Retries allowed per outbound call, and the most that can be saved up
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_MAX_TOKENS = 20
+
+# The outbound calls each worker makes per second, 0 for no limit. The API
+# quotas are per project, so divide them between every worker process.
+MESSAGE_RATE_PER_SECOND = float(os.environ.get('BM_MESSAGE_RATE_PER_SECOND', '0'))
+EVENT_RATE_PER_SECOND = float(os.environ.get('BM_EVENT_RATE_PER_SECOND', '0'))
+CONVERSATION_RATE_PER_SECOND = float(os.environ.get('BM_CONVERSATION_RATE_PER_SECOND', '0'))
+
+# How many seconds of outbound calls can be made at once after a quiet period
+RATE_LIMIT_BURST_SECONDS = float(os.environ.get('BM_RATE_LIMIT_BURST_SECONDS', '1'))
+
+# The most conversations whose outbound calls are limited separately
+RATE_LIMIT_MAX_CONVERSATIONS = 10000
+
+# HTTP statuses of outbound calls that are worth retrying
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+# The transient failures in a row that stop outbound calls, and for how long
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('BM_CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_SECONDS = float(os.environ.get('BM_CIRCUIT_RESET_SECONDS', '10'))
+
+# How the typing events and the message of each reply are sent:
+# - sequential - Three requests, one after the other
+# - batch - A single HTTP batch request; the API may apply the parts in any order
+# - overlap - The typing started event is sent while the reply is built
+SEND_MODE_SEQUENTIAL = 'sequential'
+SEND_MODE_BATCH = 'batch'
+SEND_MODE_OVERLAP = 'overlap'
+SEND_MODE = os.environ.get('BM_SEND_MODE', SEND_MODE_SEQUENTIAL).lower()
+
+# Acknowledge webhooks as soon as they are queued and reply in the background
+ASYNC_ACK = os.environ.get('BM_ASYNC_ACK', 'false').lower() == 'true'
+
+# The number of background threads sending replies when ASYNC_ACK is on.
+# Each thread serves its own share of conversations, in order.
+SEND_WORKERS = int(os.environ.get('BM_SEND_WORKERS', '8'))
+
+# The most replies that may wait for a background thread
+SEND_QUEUE_SIZE = int(os.environ.get('BM_SEND_QUEUE_SIZE', '1000'))
+
+# How long a webhook waits for room in its conversation's queue before it
+# is shed
+SEND_QUEUE_WAIT_SECONDS = float(os.environ.get('BM_SEND_QUEUE_WAIT_MS', '100')) / 1000
+
+# The database recording the replies queued when ASYNC_ACK is on, so they are
+# sent even if the worker stops first. Set to an empty string to turn it off.
+OUTBOX_PATH = os.environ.get(
+    'BM_OUTBOX_PATH', os.path.join(tempfile.gettempdir(), 'bm-echo-bot-outbox.db'))
+
+# How old a reply left behind by a stopped worker, or whose send failed, may
+# be and still be sent
+OUTBOX_MAX_AGE_SECONDS = float(os.environ.get('BM_OUTBOX_MAX_AGE_SECONDS', '600'))
+
+# How long the replies of a worker that stopped renewing its lease on the
+# outbox wait before another worker sends them
+OUTBOX_LEASE_SECONDS = float(os.environ.get('BM_OUTBOX_LEASE_SECONDS', '30'))
+
+# How long a stopping worker waits for the replies being sent and queued
+DRAIN_TIMEOUT_SECONDS = float(os.environ.get('BM_DRAIN_TIMEOUT_SECONDS', '10'))
+
+# The partner keys that webhooks may be signed with, separated by commas. To
+# rotate the key, add the new one before removing the old one. When unset,
+# webhook signatures are not checked.
+PARTNER_KEYS = [key for key in os.environ.get('BM_PARTNER_KEYS', '').split(',') if key]
+
+# The largest webhook body accepted
+MAX_WEBHOOK_BYTES = int(os.environ.get('BM_MAX_WEBHOOK_BYTES', '65536'))
+
+# How far into each webhook body to look for events that need no reply
+WEBHOOK_SNIFF_BYTES = 1024
+
+# The most webhooks each worker handles at once, 0 for no limit, and the most
+# user messages that wait for a turn. Other webhooks are shed straight away.
+MAX_IN_FLIGHT = int(os.environ.get('BM_MAX_IN_FLIGHT', '32'))
+MAX_QUEUED = int(os.environ.get('BM_MAX_QUEUED', '64'))
+
+# The longest a user message waits for a turn before it is shed
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(
+    os.environ.get('BM_ADMISSION_QUEUE_TIMEOUT_MS', '2000')) / 1000
+
+# The Retry-After sent with webhooks that are shed
+SHED_RETRY_AFTER_SECONDS = int(os.environ.get('BM_SHED_RETRY_AFTER_SECONDS', '1'))
+
+# How long, and for how many webhooks, redeliveries are recognised and dropped
+DEDUP_TTL_SECONDS = int(os.environ.get('BM_DEDUP_TTL_SECONDS', '600'))
+DEDUP_MAX_ENTRIES = int(os.environ.get('BM_DEDUP_MAX_ENTRIES', '10000'))
+
+# Where redeliveries are remembered:
+# - shared - In a table shared by every worker process on this instance
+# - memory - Separately by each worker process
+DEDUP_STORE_SHARED = 'shared'
+DEDUP_STORE_MEMORY = 'memory'
+DEDUP_STORE_TYPE = os.environ.get('BM_DEDUP_STORE', DEDUP_STORE_SHARED).lower()
+
+# The file backing the table shared by the worker processes, and its size.
+# Every worker must use the same values.
+SHARED_TABLE_PATH = os.environ.get(
+    'BM_SHARED_TABLE_PATH', os.path.join(tempfile.gettempdir(), 'bm-echo-bot-shared-table'))
+SHARED_TABLE_SLOTS = int(os.environ.get('BM_SHARED_TABLE_SLOTS', '65536'))
+
+# How long each per-second count of outbound API calls is kept
+OUTBOUND_COUNT_TTL_SECONDS = 2
+
+# How long before expiry the background refresher renews the access token
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.environ.get('BM_TOKEN_REFRESH_MARGIN_SECONDS', '300'))
+
+# How long the background refresher waits before retrying a failed refresh
+TOKEN_REFRESH_RETRY_SECONDS = 10
+
+# The longest the background refresher sleeps before rechecking the token
+TOKEN_REFRESH_MAX_SLEEP_SECONDS = 60
+
 # Set of commands the bot understands
 CMD_RICH_CARD = 'card'
 CMD_CAROUSEL_CARD = 'carousel'
 CMD_SUGGESTIONS = 'chips'
 
+# Name used for any message that is not a command and gets echoed back
+CMD_ECHO = 'echo'
+
+# The postbackData of the sample suggestions
+POSTBACK_SAMPLE_CHIP = 'sample_chip'
+POSTBACK_URL_ACTION = 'url_action'
+POSTBACK_DIAL_ACTION = 'dial_action'
+
+# When set, typing events are only sent for replies that are not ready within
+# this many milliseconds. Override it per command with BM_TYPING_DELAY_MS_<COMMAND>,
+# e.g. BM_TYPING_DELAY_MS_CAROUSEL. When unset, every reply sends typing events.
+ADAPTIVE_TYPING = 'BM_TYPING_DELAY_MS' in os.environ
+TYPING_DELAY_MS = int(os.environ.get('BM_TYPING_DELAY_MS', '0'))
+TYPING_DELAYS_MS = {
+    name[len('BM_TYPING_DELAY_MS_'):].lower(): int(value)
+    for name, value in os.environ.items() if name.startswith('BM_TYPING_DELAY_MS_')
+}
+
 # Images used in cards and carousel examples
 SAMPLE_IMAGES = [
     'https://storage.googleapis.com/kitchen-sink-sample-images/cute-dog.jpg',
@@ -58,76 +273,844 @@ SAMPLE_IMAGES = [
     'https://storage.googleapis.com/kitchen-sink-sample-images/golden-gate-bridge.jpg',
 ]
 
+# The kinds of outbound API call, as labelled in the metrics
+API_CALL_EVENT = 'event'
+API_CALL_MESSAGE = 'message'
+API_CALL_BATCH = 'batch'
+
+# Typing indicator events sent around each message
+TYPING_STARTED = BusinessMessagesEvent.EventTypeValueValuesEnum.TYPING_STARTED
+TYPING_STOPPED = BusinessMessagesEvent.EventTypeValueValuesEnum.TYPING_STOPPED
+
 # The representative type that all messages are sent as
 BOT_REPRESENTATIVE = BusinessMessagesRepresentative(
     representativeType=BusinessMessagesRepresentative.RepresentativeTypeValueValuesEnum.BOT,
     displayName='Echo Bot',
     avatarImage='https://storage.googleapis.com/sample-avatars-for-bm/bot-avatar.jpg')
 
+class ClientCache(object):
+    '''
+    Caches the service account credentials and Business Messages client so
+    they are built once per worker instead of once per message.
+
+    The credentials, and the OAuth access token they hold, are shared by all
+    threads and only reloaded when the credentials file changes or after an
+    authorization failure. The client sends through a pool of keep-alive
+    connections, so a single client is shared by every thread as well.
+    '''
+
+    def __init__(self, credentials_location, http_pool):
+        self._credentials_location = credentials_location
+        self._http_pool = http_pool
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._credentials_mtime = None
+        self._generation = 0
+        self._client = None
+        self._client_generation = None
+
+    def get_credentials(self):
+        '''
+        Returns the cached credentials, loading them from disk on first use
+        or when the credentials file has been modified.
+
+        Returns:
+           A :tuple: The ServiceAccountCredentials and their generation number.
+        '''
+        mtime = os.stat(self._credentials_location).st_mtime
+
+        with self._lock:
+            if self._credentials is None or mtime != self._credentials_mtime:
+                self._credentials = ServiceAccountCredentials.from_json_keyfile_name(
+                    self._credentials_location, scopes=BM_API_SCOPES)
+                self._credentials_mtime = mtime
+                self._generation += 1
+
+            return self._credentials, self._generation
+
+    def get_client(self):
+        '''
+        Returns the shared Business Messages client.
+
+        Returns:
+           A :obj: A BusinessmessagesV1 client.
+        '''
+        credentials, generation = self.get_credentials()
+
+        with self._lock:
+            if self._client_generation != generation:
+                self._client = bm_client.BusinessmessagesV1(
+                    credentials=credentials, http=PooledHttp(self._http_pool))
+                # Calls are retried by RETRY_POLICY, within the retry budget
+                self._client.num_retries = 0
+                self._client_generation = generation
+
+            return self._client
+
+    def invalidate(self):
+        '''
+        Drops the cached credentials so they are reloaded on next use.
+        '''
+        with self._lock:
+            self._credentials = None
+
+# The outbound connections shared by every request in this worker
+HTTP_POOL = HttpConnectionPool(HTTP_POOL_SIZE, HTTP_TIMEOUT_SECONDS)
+
+# The credentials and client shared by every request in this worker
+CLIENT_CACHE = ClientCache(SERVICE_ACCOUNT_LOCATION, HTTP_POOL)
+
+class TokenRefresher(object):
+    '''
+    Keeps the cached access token valid from a background thread so that
+    webhook requests never wait for a token to be minted.
+
+    The token is renewed a configurable margin before it expires. If the
+    background refresh keeps failing and the token expires anyway, the
+    request path falls back to refreshing it synchronously.
+    '''
+
+    def __init__(self, client_cache, http_pool, margin_seconds):
+        self._client_cache = client_cache
+        self._http_pool = http_pool
+        self._margin_seconds = margin_seconds
+        self._start_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._pid = None
+
+        METRICS.register_gauge('bm_token_seconds_until_expiry', self.seconds_until_expiry)
+
+    def ensure_started(self):
+        '''
+        Starts the background thread unless it is already running in this
+        process. Threads do not survive a fork, so this is checked per pid.
+        '''
+        if self._pid == os.getpid():
+            return
+
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._stop_event.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name='token-refresher', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        '''
+        Stops the background thread.
+        '''
+        self._stop_event.set()
+
+    def ensure_valid(self, credentials):
+        '''
+        Makes sure the credentials hold a usable access token, refreshing
+        synchronously only if the background refresher has fallen behind.
+
+        Args:
+            credentials (obj): The ServiceAccountCredentials to check.
+        '''
+        if credentials.access_token and not credentials.access_token_expired:
+            return
+
+        with self._refresh_lock:
+            if credentials.access_token and not credentials.access_token_expired:
+                return
+
+            METRICS.increment('bm_token_sync_refreshes_total')
+            self._refresh(credentials)
+
+    def seconds_until_expiry(self):
+        '''
+        Returns how long the current access token remains valid.
+
+        Returns:
+           A :float: Seconds until expiry, or 0 if there is no token yet.
+        '''
+        credentials, _ = self._client_cache.get_credentials()
+
+        if not credentials.access_token or not credentials.token_expiry:
+            return 0
+
+        remaining = credentials.token_expiry - datetime.datetime.utcnow()
+
+        return max(remaining.total_seconds(), 0)
+
+    def _run(self):
+        '''
+        Refreshes the token whenever it is within the margin of expiring.
+        '''
+        while not self._stop_event.is_set():
+            try:
+                credentials, _ = self._client_cache.get_credentials()
+                delay = self.seconds_until_expiry() - self._margin_seconds
+
+                if delay <= 0:
+                    with self._refresh_lock:
+                        # A request may have refreshed it while we waited
+                        if self.seconds_until_expiry() <= self._margin_seconds:
+                            self._refresh(credentials)
+
+                    # A margin as long as the token lifetime would otherwise
+                    # refresh again straight away
+                    delay = max(self.seconds_until_expiry() - self._margin_seconds,
+                                TOKEN_REFRESH_RETRY_SECONDS)
+            except Exception:  # pylint: disable=broad-except
+                logging.getLogger(__name__).exception('Background token refresh failed')
+                delay = TOKEN_REFRESH_RETRY_SECONDS
+
+            self._stop_event.wait(min(delay, TOKEN_REFRESH_MAX_SLEEP_SECONDS))
+
+    def _refresh(self, credentials):
+        '''
+        Fetches a new access token and records how long it took.
+
+        Args:
+            credentials (obj): The ServiceAccountCredentials to refresh.
+        '''
+        start_time = time.time()
+
+        try:
+            credentials.refresh(PooledHttp(self._http_pool))
+        except Exception:
+            METRICS.increment('bm_token_refresh_failures_total')
+            raise
+        finally:
+            METRICS.observe('bm_token_refresh_seconds', time.time() - start_time)
+
+# Keeps the shared access token warm for every request in this worker
+TOKEN_REFRESHER = TokenRefresher(CLIENT_CACHE, HTTP_POOL, TOKEN_REFRESH_MARGIN_SECONDS)
+
+# Dedup keys and outbound call counts shared by the workers on this instance
+SHARED_TABLE = SharedTable(SHARED_TABLE_PATH, SHARED_TABLE_SLOTS)
+METRICS.register_gauge('bm_outbound_calls_last_second', lambda: get_outbound_calls_last_second())
+
+# The webhooks recently processed on this instance. Replace this with a store
+# shared by all instances (see dedup.py) to also catch redeliveries that land
+# on another instance.
+if DEDUP_STORE_TYPE == DEDUP_STORE_MEMORY:
+    DEDUP_STORE = InMemoryDedupStore(DEDUP_MAX_ENTRIES, DEDUP_TTL_SECONDS)
+else:
+    DEDUP_STORE = SharedDedupStore(SHARED_TABLE, DEDUP_TTL_SECONDS)
+
+# Sends typing started events while replies are built in SEND_MODE_OVERLAP
+TYPING_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    HTTP_POOL_SIZE, thread_name_prefix='typing-sender')
+
+# Sends replies in the background when ASYNC_ACK is enabled
+SEND_POOL = SendWorkerPool(SEND_WORKERS, SEND_QUEUE_SIZE, SEND_QUEUE_WAIT_SECONDS)
+
+# Drains the replies being sent when the worker is stopped
+SHUTDOWN = ShutdownCoordinator(
+    DRAIN_TIMEOUT_SECONDS, SEND_POOL,
+    lambda conversation_id: send_event(get_client(), conversation_id, TYPING_STOPPED))
+
+# Records queued replies until they are sent
+OUTBOX = (Outbox(OUTBOX_PATH, OUTBOX_MAX_AGE_SECONDS, OUTBOX_LEASE_SECONDS,
+                 lambda entry: replay_outbox_entry(entry))
+          if ASYNC_ACK and OUTBOX_PATH else None)
+
+# The commands the bot understands, registered with @COMMANDS.command
+COMMANDS = CommandRouter()
+
+# Stops outbound calls while the Business Messages API is failing
+CIRCUIT_BREAKER = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+
+# Keeps outbound calls within the API quotas, dropping typing events first
+RATE_LIMITER = OutboundRateLimiter(
+    MESSAGE_RATE_PER_SECOND, EVENT_RATE_PER_SECOND, CONVERSATION_RATE_PER_SECOND,
+    RATE_LIMIT_BURST_SECONDS, HTTP_TIMEOUT_SECONDS, RATE_LIMIT_MAX_CONVERSATIONS)
+
+# Retries outbound calls that fail with transient errors
+RETRY_POLICY = RetryPolicy(
+    RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY_SECONDS, RETRY_MAX_DELAY_SECONDS,
+    RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MAX_TOKENS), CIRCUIT_BREAKER,
+    lambda error: is_retryable_error(error),
+    lambda error: isinstance(error, apitools_exceptions.HttpError))
+
+class ReplyTemplates(object):
+    '''
+    Builds each static reply once, on first use, and hands out copies that
+    only differ in their messageId.
+
+    The copies are shallow: the rich cards, suggestions and representative
+    are shared between every copy of a template and must not be modified.
+
+    The JSON encoding of each template is cached as well, split around the
+    messageId, so unmodified copies can be sent without running the protorpc
+    encoder again. When a template is built its cached encoding is checked
+    byte for byte against the encoder, and the cache is not used for that
+    template if the two differ.
+    '''
+
+    # Stands in for the messageId while a template is encoded
+    MESSAGE_ID_PLACEHOLDER = 'REPLY_TEMPLATE_MESSAGE_ID'
+
+    def __init__(self, builders):
+        '''
+        Args:
+            builders (dict): Maps each template name to a function building
+                its BusinessMessagesMessage.
+        '''
+        self._builders = builders
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        '''
+        Returns a copy of a template stamped with a new messageId.
+
+        Args:
+            name (str): The template name.
+
+        Returns:
+           A :obj: A BusinessMessagesMessage object.
+        '''
+        fields, _ = self._get_template(name)
+
+        message = BusinessMessagesMessage(**fields)
+        message.messageId = str(uuid.uuid4().int)
+
+        return message
+
+    def encode(self, message):
+        '''
+        Returns the cached JSON encoding of an unmodified template copy.
+
+        Args:
+            message (obj): A BusinessMessagesMessage object.
+
+        Returns:
+           A :bytes: The encoded message, or None if the message is not an
+           unmodified copy of a template.
+        '''
+        for fields, json_parts in list(self._templates.values()):
+            if json_parts is not None and _is_copy_of(message, fields):
+                return json_parts[0] + json.dumps(message.messageId).encode('utf-8') + json_parts[1]
+
+        return None
+
+    def _get_template(self, name):
+        '''
+        Returns the fields and split JSON encoding of a template, building
+        them on first use.
+        '''
+        template = self._templates.get(name)
+
+        if template is None:
+            with self._lock:
+                if name not in self._templates:
+                    self._templates[name] = self._build_template(name)
+
+                template = self._templates[name]
+
+        return template
+
+    def _build_template(self, name):
+        '''
+        Builds a template and splits its JSON encoding around the messageId.
+        '''
+        message = self._builders[name]()
+        fields = {
+            field.name: message.get_assigned_value(field.name)
+            for field in message.all_fields()
+            if field.name != 'messageId' and message.get_assigned_value(field.name) is not None
+        }
+
+        placeholder = BusinessMessagesMessage(messageId=self.MESSAGE_ID_PLACEHOLDER, **fields)
+        parts = encoding.MessageToJson(placeholder).encode('utf-8').split(
+            json.dumps(self.MESSAGE_ID_PLACEHOLDER).encode('utf-8'))
+        json_parts = tuple(parts) if len(parts) == 2 else None
+
+        # Make sure splicing in a real messageId matches the encoder exactly
+        sample = BusinessMessagesMessage(messageId=str(uuid.uuid4().int), **fields)
+        if json_parts is not None and encoding.MessageToJson(sample).encode('utf-8') != (
+                json_parts[0] + json.dumps(sample.messageId).encode('utf-8') + json_parts[1]):
+            json_parts = None
+
+        if json_parts is None:
+            logging.getLogger(__name__).warning(
+                'JSON cache disabled for reply template %s', name)
+
+        return fields, json_parts
+
+def _is_copy_of(message, fields):
+    '''
+    Checks whether a message holds exactly the given field values, apart
+    from its messageId. Values are compared by identity, so this is cheap.
+    '''
+    for field in message.all_fields():
+        if field.name == 'messageId':
+            continue
+
+        value = message.get_assigned_value(field.name)
+        expected = fields.get(field.name)
+
+        if field.repeated:
+            value, expected = value or (), expected or ()
+
+            if len(value) != len(expected) or any(
+                    item is not expected_item for item, expected_item in zip(value, expected)):
+                return False
+        elif value is not expected:
+            return False
+
+    return True
+
+# The static replies, built once per worker on first use. The builders are
+# defined further down, so they are looked up when a template is first needed.
+REPLY_TEMPLATES = ReplyTemplates({
+    CMD_RICH_CARD: lambda: build_rich_card(),
+    CMD_CAROUSEL_CARD: lambda: build_carousel(),
+    CMD_SUGGESTIONS: lambda: build_message_with_suggestions(),
+})
+
+class TypingIndicator(object):
+    '''
+    Sends the typing started event for a reply on a helper thread while the
+    reply is being built, optionally only if the reply is not ready within
+    a delay, so instant replies skip the typing events altogether.
+    '''
+
+    def __init__(self, client, conversation_id, delay_seconds):
+        '''
+        Args:
+            client (obj): The BusinessmessagesV1 client to send with.
+            conversation_id (str): The unique id for this user and agent.
+            delay_seconds (float): How long to wait for the reply before
+                showing the typing indicator. 0 shows it straight away.
+        '''
+        self._client = client
+        self._conversation_id = conversation_id
+        self._delay_seconds = delay_seconds
+        self._reply_ready = threading.Event()
+        self._future = TYPING_EXECUTOR.submit(self._run)
+
+    def reply_ready(self):
+        '''
+        Marks the reply as ready to send, waiting for the typing started
+        event to be delivered if it was already on its way.
+
+        Returns:
+           A :bool: True if the typing started event was sent.
+        '''
+        self._reply_ready.set()
+
+        return self._future.result()
+
+    def cancel(self):
+        '''
+        Stops the typing indicator of a reply that will not be sent, sending
+        the typing stopped event if the typing started event was sent.
+        '''
+        try:
+            if self.reply_ready():
+                send_event(self._client, self._conversation_id, TYPING_STOPPED)
+        except Exception:  # pylint: disable=broad-except
+            logging.getLogger(__name__).warning(
+                'Failed to stop the typing indicator of %s', self._conversation_id,
+                exc_info=True)
+
+    def _run(self):
+        '''
+        Sends the typing started event unless the reply is ready in time.
+        '''
+        if self._delay_seconds and self._reply_ready.wait(self._delay_seconds):
+            # The reply was ready before a typing indicator was worth showing
+            METRICS.increment('bm_typing_events_suppressed_total', 2)
+            return False
+
+        return send_event(self._client, self._conversation_id, TYPING_STARTED)
+
 app = Flask(__name__, static_url_path='')
-app.config['DEBUG'] = True
+app.config['DEBUG'] = PROFILE == PROFILE_DEV
+
+# Write every log record from a background thread, as JSON in production
+LOG_STREAM_HANDLER = logging.StreamHandler()
+LOG_STREAM_HANDLER.setFormatter(LogFormatter(structured=PROFILE == PROFILE_PROD))
+LOG_HANDLER = AsyncLogHandler(LOG_STREAM_HANDLER, LOG_QUEUE_SIZE)
+logging.getLogger().addHandler(LOG_HANDLER)
+app.logger.removeHandler(default_handler)
+app.logger.setLevel(logging.DEBUG if PROFILE == PROFILE_DEV else logging.INFO)
+
+# One line per webhook with its status and stage timings
+ACCESS_LOGGER = logging.getLogger('access')
+ACCESS_LOGGER.setLevel(logging.INFO)
+
+# Checks the signatures of webhooks, or None when signatures are not checked
+SIGNATURE_VERIFIER = SignatureVerifier(PARTNER_KEYS) if PARTNER_KEYS else None
+
+# Picks the webhooks whose bodies are logged
+PAYLOAD_COUNTER = itertools.count()
+
+# Profiles sampled webhooks when profiling is turned on
+PROFILER = RequestProfiler(PROFILER_SAMPLE_EVERY, ADMIN_TOKEN, PROFILER_SAMPLE_INTERVAL_SECONDS)
+
+# Answer forged webhooks and typing and receipt events before Flask sees them,
+# and shed webhooks while the worker is overloaded
+app.wsgi_app = WebhookFilter(
+    app.wsgi_app, '/callback', SIGNATURE_VERIFIER, MAX_WEBHOOK_BYTES, WEBHOOK_SNIFF_BYTES,
+    AdmissionController(MAX_IN_FLIGHT, MAX_QUEUED, ADMISSION_QUEUE_TIMEOUT_SECONDS)
+    if MAX_IN_FLIGHT else None,
+    SHED_RETRY_AFTER_SECONDS)
+
+@app.before_request
+def start_request():
+    """
+    Starts timing the request for the access log, and profiling it if it
+    is sampled.
+    """
+    if ACCESS_LOG:
+        request_log.start_request()
+
+    if PROFILER.enabled and request.path == '/callback':
+        g.profile = PROFILER.start(request.headers.get(ADMIN_TOKEN_HEADER))
+
+@app.teardown_request
+def stop_profiling(_):
+    """
+    Adds the results of a profiled request to the profiler.
+    """
+    profile = g.pop('profile', None)
+
+    if profile is not None:
+        PROFILER.stop(profile)
+
+@app.after_request
+def log_access(response):
+    """
+    Writes the access log line for the request.
+    """
+    duration_ms, stages = request_log.finish_request()
+
+    if duration_ms is not None:
+        ACCESS_LOGGER.info('%s %s %s', request.method, request.path, response.status_code,
+                           extra={'fields': {
+                               'method': request.method,
+                               'path': request.path,
+                               'status': response.status_code,
+                               'duration_ms': duration_ms,
+                               'stages_ms': stages,
+                           }})
+
+    return response
 
 @app.route('/callback', methods=['POST'])
 def callback():
     """
     Callback URL. Processes messages sent from user.
     """
-    request_body = request.json
+    if SHUTDOWN.draining:
+        # Let Business Messages redeliver the webhook to a worker that is not stopping
+        return '', 503, {'Retry-After': str(SHED_RETRY_AFTER_SECONDS)}
+
+    raw_body = request.get_data()
+
+    if LOG_PAYLOAD_EVERY and next(PAYLOAD_COUNTER) % LOG_PAYLOAD_EVERY == 0:
+        app.logger.info('request_body: %s', raw_body.decode('utf-8', 'replace'))
+
+    try:
+        with METRICS.time('bm_stage_seconds', {'stage': 'parse'}):
+            event = parse_event(raw_body)
+    except ValueError:
+        return 'Invalid webhook body', 400
 
-    app.logger.debug('request_body: %s', json.dumps(request_body))
+    request_log.lap('parse')
 
     # To set a webhook, extract the secret from the request and return it
-    if 'secret' in request_body:
-        return request_body.get('secret')
-
-    # Extract the conversation id and message text
-    conversation_id = request_body['conversationId']
-    app.logger.debug('conversation_id: %s', conversation_id)
-
-    # Check that the message and text body exist
-    if 'message' in request_body and 'text' in request_body['message']:
-        message = request_body['message']['text']
-
-        app.logger.debug('message: %s', message)
-        route_message(message, conversation_id)
-    elif 'suggestionResponse' in request_body:
-        message = request_body['suggestionResponse']['text']
-
-        app.logger.debug('message: %s', message)
-        route_message(message, conversation_id)
-    elif 'userStatus' in request_body:
-        if 'isTyping' in request_body['userStatus']:
+    if event.kind == EVENT_SECRET:
+        return event.secret
+
+    # Drop webhooks that were redelivered after already being processed
+    dedup_key = event.dedup_key
+
+    with METRICS.time('bm_stage_seconds', {'stage': 'dedup'}):
+        is_new = dedup_key is None or DEDUP_STORE.add(dedup_key)
+
+    if not is_new:
+        METRICS.increment('bm_webhook_duplicates_dropped_total')
+        app.logger.debug('Dropping duplicate webhook: %s', dedup_key)
+        return ''
+
+    request_log.lap('dedup')
+
+    try:
+        handle_event(event)
+    except SendQueueFullError:
+        # Let Business Messages redeliver the webhook once the queue has drained
+        if dedup_key is not None:
+            DEDUP_STORE.discard(dedup_key)
+
+        return '', 503, {'Retry-After': str(SHED_RETRY_AFTER_SECONDS)}
+    except Exception:
+        app.logger.error('Failed to handle webhook: %s', raw_body.decode('utf-8', 'replace'))
+
+        # Let the redelivery of a webhook that failed be processed again
+        if dedup_key is not None:
+            DEDUP_STORE.discard(dedup_key)
+        raise
+
+    request_log.lap('dispatch')
+
+    return ''
+
+def handle_event(event):
+    '''
+    Handles a message or status event sent from the user.
+
+    Args:
+        event (obj): The WebhookEvent parsed from the request.
+    '''
+    app.logger.debug('conversation_id: %s', event.conversation_id)
+
+    if event.kind == EVENT_MESSAGE:
+        app.logger.debug('message: %s', event.text)
+        dispatch_message(event.text, event.conversation_id)
+    elif event.kind == EVENT_SUGGESTION_RESPONSE:
+        app.logger.debug('message: %s, postback_data: %s', event.text, event.postback_data)
+        dispatch_message(event.text, event.conversation_id, event.postback_data)
+    elif event.kind == EVENT_USER_STATUS:
+        if event.is_typing:
             app.logger.debug('User is typing')
-        elif 'requestedLiveAgent' in request_body['userStatus']:
+        elif event.requested_live_agent:
             app.logger.debug('User requested transfer to live agent')
 
-    return ''
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Reports this worker's metrics in the Prometheus text format.
+    """
+    return METRICS.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    """
+    Dumps the results of the profiled webhooks. Requires the admin token.
+
+    Query parameters:
+        format: pstats (default), text or collapsed.
+        reset: true to discard the results after dumping them.
+    """
+    if not PROFILER.is_admin(request.headers.get(ADMIN_TOKEN_HEADER)):
+        return 'Not found', 404
+
+    output_format = request.args.get('format', 'pstats')
+
+    try:
+        body = PROFILER.dump(output_format)
+    except ValueError:
+        return 'Unknown format', 400
+
+    if request.args.get('reset') == 'true':
+        PROFILER.reset()
+
+    content_type = 'application/octet-stream' if output_format == 'pstats' else 'text/plain'
+
+    return body, 200, {'Content-Type': content_type}
 
-def route_message(message, conversation_id):
+def dispatch_message(message, conversation_id, postback_data=None):
     '''
-    Routes the message received from the user to create a response.
+    Routes the message on a background worker when ASYNC_ACK is enabled,
+    keeping replies within a conversation in order.
 
     Args:
         message (str): The message text received from the user.
         conversation_id (str): The unique id for this user and agent.
+        postback_data (str): The postbackData of the suggestion the user
+            tapped, if any.
+
+    Raises:
+        SendQueueFullError: If the conversation's queue stayed full, so the
+            webhook should be redelivered later.
     '''
-    normalized_message = message.lower()
+    if not ASYNC_ACK:
+        route_message(message, conversation_id, postback_data)
+        return
+
+    # Record the reply before the webhook is acknowledged
+    outbox_entry_id = (OUTBOX.add(conversation_id, message, postback_data)
+                       if OUTBOX is not None else None)
 
-    if normalized_message == CMD_RICH_CARD:
-        send_rich_card(conversation_id)
-    elif normalized_message == CMD_CAROUSEL_CARD:
-        send_carousel(conversation_id)
-    elif normalized_message == CMD_SUGGESTIONS:
-        send_message_with_suggestions(conversation_id)
+    if outbox_entry_id is None:
+        queued = SEND_POOL.submit(conversation_id, route_message,
+                                  message, conversation_id, postback_data)
     else:
-        echo_message(message, conversation_id)
+        queued = SEND_POOL.submit(conversation_id, send_with_outbox, outbox_entry_id,
+                                  route_message, message, conversation_id, postback_data,
+                                  outbox_entry_id)
+
+    if queued:
+        return
+
+    # Sending the reply here would overtake the replies queued before it, so
+    # the webhook fails and its redelivery builds the reply again
+    if outbox_entry_id is not None:
+        OUTBOX.remove(outbox_entry_id)
+
+    raise SendQueueFullError('The send queue of %s is full' % conversation_id)
 
-def send_rich_card(conversation_id):
+def route_message(message, conversation_id, postback_data=None, outbox_entry_id=None):
     '''
-    Sends a sample rich card to the user.
+    Routes the message received from the user to create a response.
 
     Args:
+        message (str): The message text received from the user.
         conversation_id (str): The unique id for this user and agent.
+        postback_data (str): The postbackData of the suggestion the user
+            tapped, if any.
+        outbox_entry_id (str): The OUTBOX entry recording the reply, if any.
+            It is removed once the reply is sent.
+    '''
+    # Tell the shutdown drain which conversations may be showing a typing indicator
+    with SHUTDOWN.sending(conversation_id):
+        command, handler = COMMANDS.route(message, postback_data)
+        typing = None
+
+        if ADAPTIVE_TYPING:
+            delay_ms = TYPING_DELAYS_MS.get(command, TYPING_DELAY_MS)
+            typing = TypingIndicator(get_client(), conversation_id, delay_ms / 1000.0)
+        elif SEND_MODE == SEND_MODE_OVERLAP:
+            # Let the typing started event travel while the reply is being built
+            typing = TypingIndicator(get_client(), conversation_id, 0)
+
+        try:
+            with METRICS.time('bm_stage_seconds', {'stage': 'build'}):
+                reply = handler(message)
+
+            request_log.lap('build')
+
+            if outbox_entry_id is not None:
+                # A replay must send the same reply, with the same messageId
+                OUTBOX.set_reply(outbox_entry_id, REPLY_TEMPLATES.encode(reply)
+                                 or encoding.MessageToJson(reply).encode('utf-8'))
+        except Exception:
+            if typing is not None:
+                # No reply will take the typing indicator down
+                typing.cancel()
+            raise
+
+        with METRICS.time('bm_stage_seconds', {'stage': 'send'}):
+            send_message(reply, conversation_id, typing)
+
+        if outbox_entry_id is not None:
+            OUTBOX.remove(outbox_entry_id)
+
+        request_log.lap('send')
+
+def replay_outbox_entry(entry):
+    '''
+    Queues a reply left in the OUTBOX by a worker that stopped, or whose
+    send failed.
+
+    Args:
+        entry (obj): The OutboxEntry to send.
+    '''
+    if not SEND_POOL.submit(entry.conversation_id, send_with_outbox, entry.entry_id,
+                            send_outbox_entry, entry):
+        # Sending here would hold up the rescan, so a later one retries it
+        OUTBOX.release(entry.entry_id)
+
+def send_with_outbox(entry_id, func, *args):
+    '''
+    Sends a reply recorded in the OUTBOX. If the send fails with a transient
+    error, the entry is handed back to be retried by a later rescan;
+    otherwise it is deleted.
+
+    Args:
+        entry_id (str): The OUTBOX entry recording the reply.
+        func (callable): Sends the reply and removes the entry.
+        *args: The arguments to call it with.
+    '''
+    try:
+        func(*args)
+    except Exception as e:
+        if is_retryable_error(e) or isinstance(
+                e, (CircuitOpenError, ThrottledError, PoolTimeoutError)):
+            OUTBOX.release(entry_id)
+        else:
+            OUTBOX.remove(entry_id)
+        raise
+
+def send_outbox_entry(entry):
+    '''
+    Sends a reply left in the OUTBOX by a worker that stopped, or whose send
+    failed, building it first if that was not done yet.
+
+    Args:
+        entry (obj): The OutboxEntry to send.
+    '''
+    if entry.reply is None:
+        route_message(entry.message, entry.conversation_id, entry.postback_data,
+                      entry.entry_id)
+        return
+
+    message = encoding.JsonToMessage(BusinessMessagesMessage, entry.reply.decode('utf-8'))
+
+    try:
+        with SHUTDOWN.sending(entry.conversation_id):
+            # The typing indicator the stopped worker started may still be showing
+            send_in_sequence(get_client(), message, entry.conversation_id, [], [TYPING_STOPPED])
+    except apitools_exceptions.HttpConflictError:
+        # The stopped worker sent the reply but did not get to record it
+        pass
+
+    OUTBOX.remove(entry.entry_id)
+
+def build_reply(message, postback_data=None):
+    '''
+    Builds the response to a message received from the user, without
+    sending it.
+
+    Args:
+        message (str): The message text received from the user.
+        postback_data (str): The postbackData of the suggestion the user
+            tapped, if any.
+
+    Returns:
+       A :obj: A BusinessMessagesMessage object.
+    '''
+    _, handler = COMMANDS.route(message, postback_data)
+
+    return handler(message)
+
+@COMMANDS.command(CMD_RICH_CARD)
+def rich_card_reply(message):
+    '''
+    Replies to the card command with a sample rich card.
+    '''
+    return REPLY_TEMPLATES.get(CMD_RICH_CARD)
+
+@COMMANDS.command(CMD_CAROUSEL_CARD)
+def carousel_reply(message):
+    '''
+    Replies to the carousel command with a sample carousel.
+    '''
+    return REPLY_TEMPLATES.get(CMD_CAROUSEL_CARD)
+
+@COMMANDS.command(CMD_SUGGESTIONS)
+def suggestions_reply(message):
+    '''
+    Replies to the chips command with a message with suggested replies.
+    '''
+    return REPLY_TEMPLATES.get(CMD_SUGGESTIONS)
+
+@COMMANDS.fallback(CMD_ECHO, postbacks=[
+    POSTBACK_SAMPLE_CHIP, POSTBACK_URL_ACTION, POSTBACK_DIAL_ACTION])
+def echo_reply(message):
+    '''
+    Replies to any other message, and to the sample suggestions, by echoing
+    it back.
+    '''
+    return build_echo_message(message)
+
+def build_rich_card():
+    '''
+    Creates a message containing a sample rich card.
+
+    Returns:
+       A :obj: A BusinessMessagesMessage object.
     '''
     fallback_text = ('Business Messages!!!\n\n'
                      + 'This is an example rich card\n\n' + SAMPLE_IMAGES[0])
@@ -146,20 +1129,18 @@ def send_rich_card(conversation_id):
                     ))
                 )))
 
-    message_obj = BusinessMessagesMessage(
+    return BusinessMessagesMessage(
         messageId=str(uuid.uuid4().int),
         representative=BOT_REPRESENTATIVE,
         richCard=rich_card,
         fallback=fallback_text)
 
-    send_message(message_obj, conversation_id)
-
-def send_carousel(conversation_id):
+def build_carousel():
     '''
-    Sends a sample rich card to the user.
+    Creates a message containing a sample carousel.
 
-    Args:
-        conversation_id (str): The unique id for this user and agent.
+    Returns:
+       A :obj: A BusinessMessagesMessage object.
     '''
     rich_card = BusinessMessagesRichCard(carouselCard=get_sample_carousel())
 
@@ -171,46 +1152,42 @@ def send_carousel(conversation_id):
                           + '\n\n' + card_content.media.contentInfo.fileUrl
                           + '\n---------------------------------------------\n\n')
 
-    message_obj = BusinessMessagesMessage(
+    return BusinessMessagesMessage(
         messageId=str(uuid.uuid4().int),
         representative=BOT_REPRESENTATIVE,
         richCard=rich_card,
         fallback=fallback_text)
 
-    send_message(message_obj, conversation_id)
-
-def send_message_with_suggestions(conversation_id):
+def build_message_with_suggestions():
     '''
-    Sends a message with a suggested replies.
+    Creates a text message with suggested replies.
 
-    Args:
-        conversation_id (str): The unique id for this user and agent.
+    Returns:
+       A :obj: A BusinessMessagesMessage object.
     '''
-    message_obj = BusinessMessagesMessage(
+    return BusinessMessagesMessage(
         messageId=str(uuid.uuid4().int),
         representative=BOT_REPRESENTATIVE,
         text='Message with suggestions',
         fallback='Your device does not support suggestions',
         suggestions=get_sample_suggestions())
 
-    send_message(message_obj, conversation_id)
-
-def echo_message(message, conversation_id):
+def build_echo_message(message):
     '''
-    Sends the message received from the user back to the user.
+    Creates a text message repeating the message received from the user.
 
     Args:
         message (str): The message text received from the user.
-        conversation_id (str): The unique id for this user and agent.
+
+    Returns:
+       A :obj: A BusinessMessagesMessage object.
     '''
-    message_obj = BusinessMessagesMessage(
+    return BusinessMessagesMessage(
         messageId=str(uuid.uuid4().int),
         representative=BOT_REPRESENTATIVE,
         text=message)
 
-    send_message(message_obj, conversation_id)
-
-def send_message(message, conversation_id):
+def send_message(message, conversation_id, typing=None):
     '''
     Posts a message to the Business Messages API, first sending
     a typing indicator event and sending a stop typing event after
@@ -219,44 +1196,304 @@ def send_message(message, conversation_id):
     Args:
         message (obj): The message object payload to send to the user.
         conversation_id (str): The unique id for this user and agent.
+        typing (obj): Optional TypingIndicator that is already taking care
+            of the typing started event for this reply.
     '''
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        SERVICE_ACCOUNT_LOCATION,
-        scopes=['https://www.googleapis.com/auth/businessmessages'])
+    if typing is None:
+        events_before, events_after = [TYPING_STARTED], [TYPING_STOPPED]
+    elif typing.reply_ready():
+        events_before, events_after = [], [TYPING_STOPPED]
+    else:
+        # No typing indicator is showing, so there is nothing to stop
+        events_before, events_after = [], []
 
-    client = bm_client.BusinessmessagesV1(credentials=credentials)
+    if CIRCUIT_BREAKER.state != CIRCUIT_CLOSED and (events_before or events_after):
+        # Save the struggling API the typing events and only send the message
+        METRICS.increment('bm_typing_events_dropped_total', len(events_before) + len(events_after))
+        events_before, events_after = [], []
 
-    # Send the typing started event
-    create_request = BusinessmessagesConversationsEventsCreateRequest(
-        eventId=str(uuid.uuid4().int),
-        businessMessagesEvent=BusinessMessagesEvent(
-            representative=BOT_REPRESENTATIVE,
-            eventType=BusinessMessagesEvent.EventTypeValueValuesEnum.TYPING_STARTED
-        ),
-        parent='conversations/' + conversation_id)
+    client = get_client()
 
-    bm_client.BusinessmessagesV1.ConversationsEventsService(
-        client=client).Create(request=create_request)
+    try:
+        if SEND_MODE == SEND_MODE_BATCH and (events_before or events_after):
+            send_batch(client, message, conversation_id, events_before, events_after)
+        else:
+            send_in_sequence(client, message, conversation_id, events_before, events_after)
+    except apitools_exceptions.HttpUnauthorizedError:
+        # The cached key may have been revoked or rotated, reload it next time
+        CLIENT_CACHE.invalidate()
+        raise
 
-    # Create the message request
-    create_request = BusinessmessagesConversationsMessagesCreateRequest(
-        businessMessagesMessage=message,
-        parent='conversations/' + conversation_id)
+def get_client():
+    '''
+    Returns the shared Business Messages client after making sure it holds
+    a valid access token.
+
+    Returns:
+       A :obj: A BusinessmessagesV1 client.
+    '''
+    with METRICS.time('bm_stage_seconds', {'stage': 'credentials'}):
+        TOKEN_REFRESHER.ensure_started()
+
+        credentials, _ = CLIENT_CACHE.get_credentials()
+        TOKEN_REFRESHER.ensure_valid(credentials)
+
+        return CLIENT_CACHE.get_client()
+
+def send_in_sequence(client, message, conversation_id, events_before, events_after):
+    '''
+    Sends the events before the message, the message and the events after
+    it using the given Business Messages client, one after the other.
+
+    Args:
+        client (obj): The BusinessmessagesV1 client to send with.
+        message (obj): The message object payload to send to the user.
+        conversation_id (str): The unique id for this user and agent.
+        events_before (list): Event types to send before the message.
+        events_after (list): Event types to send after the message.
+    '''
+    for event_type in events_before:
+        send_event(client, conversation_id, event_type)
+
+    encoded_message = REPLY_TEMPLATES.encode(message)
+
+    def create_message(attempt):
+        # Every attempt counts against the quota, retries included
+        RATE_LIMITER.acquire_message(conversation_id)
+
+        with observe_api_call(API_CALL_MESSAGE):
+            try:
+                if encoded_message is not None:
+                    create_encoded_message(client, encoded_message, conversation_id)
+                else:
+                    # Create the message request
+                    create_request = BusinessmessagesConversationsMessagesCreateRequest(
+                        businessMessagesMessage=message,
+                        parent='conversations/' + conversation_id)
+
+                    bm_client.BusinessmessagesV1.ConversationsMessagesService(
+                        client=client).Create(request=create_request)
+            except apitools_exceptions.HttpConflictError:
+                # Retries reuse the message id, so a conflict means an earlier
+                # attempt was delivered even though it appeared to fail
+                if attempt == 1:
+                    raise
+
+    RETRY_POLICY.call(create_message)
+
+    for event_type in events_after:
+        send_event(client, conversation_id, event_type)
+
+def send_batch(client, message, conversation_id, events_before, events_after):
+    '''
+    Sends the events and the message in a single HTTP batch request.
+
+    The API does not guarantee the order in which the parts of a batch are
+    applied, so the typing indicator may be shown after the message arrives.
+
+    Args:
+        client (obj): The BusinessmessagesV1 client to send with.
+        message (obj): The message object payload to send to the user.
+        conversation_id (str): The unique id for this user and agent.
+        events_before (list): Event types to send before the message.
+        events_after (list): Event types to send after the message.
+    '''
+    # Each part of a batch counts against the quota, and events are dropped
+    # rather than waited for
+    events_before = [event_type for event_type in events_before
+                     if RATE_LIMITER.try_acquire_event(conversation_id)]
+    events_after = [event_type for event_type in events_after
+                    if RATE_LIMITER.try_acquire_event(conversation_id)]
+    RATE_LIMITER.acquire_message(conversation_id)
+
+    batch_request = batch.BatchApiRequest(
+        batch_url=client.url + 'batch', response_encoding='utf-8')
+
+    for event_type in events_before:
+        batch_request.Add(client.conversations_events, 'Create',
+                          create_event_request(conversation_id, event_type))
+
+    batch_request.Add(client.conversations_messages, 'Create',
+                      BusinessmessagesConversationsMessagesCreateRequest(
+                          businessMessagesMessage=message,
+                          parent='conversations/' + conversation_id))
+
+    for event_type in events_after:
+        batch_request.Add(client.conversations_events, 'Create',
+                          create_event_request(conversation_id, event_type))
+
+    def execute_batch(_):
+        with observe_api_call(API_CALL_BATCH, len(events_before) + 1 + len(events_after)):
+            api_calls = batch_request.Execute(client.http, max_retries=1)
+            message_call = api_calls.pop(len(events_before))
+
+            for api_call in api_calls:
+                if api_call.is_error or api_call.response is None:
+                    # A missing typing indicator is not worth failing the reply for
+                    METRICS.increment('bm_typing_events_failed_total')
+                    logging.getLogger(__name__).warning(
+                        'Failed to send batched event: %s',
+                        api_call.exception or 'Batched API call did not complete')
+
+            if message_call.is_error:
+                raise message_call.exception
+
+            if message_call.response is None:
+                raise apitools_exceptions.BatchError('Batched API call did not complete')
+
+    # Some parts of a failed batch may have been applied, so it is not retried
+    RETRY_POLICY.call(execute_batch, max_attempts=1)
+
+def create_encoded_message(client, encoded_message, conversation_id):
+    '''
+    Sends a message that is already encoded as JSON, bypassing the protorpc
+    encoder in the generated client.
+
+    Args:
+        client (obj): The BusinessmessagesV1 client to send with.
+        encoded_message (bytes): The JSON encoded BusinessMessagesMessage.
+        conversation_id (str): The unique id for this user and agent.
+    '''
+    http_request = http_wrapper.Request(
+        url=client.url + 'v1/conversations/' + conversation_id + '/messages?alt=json',
+        http_method='POST',
+        headers={
+            'content-type': 'application/json',
+            'accept': 'application/json',
+            'user-agent': client.user_agent,
+        },
+        body=encoded_message)
+
+    http_response = http_wrapper.MakeRequest(
+        client.http, http_request, retries=client.num_retries,
+        max_retry_wait=client.max_retry_wait)
+
+    if http_response.status_code not in (200, 201, 204):
+        raise apitools_exceptions.HttpError.FromResponse(http_response)
 
-    bm_client.BusinessmessagesV1.ConversationsMessagesService(
-        client=client).Create(request=create_request)
+def send_event(client, conversation_id, event_type):
+    '''
+    Sends an event, such as a typing indicator, to the user.
+
+    Args:
+        client (obj): The BusinessmessagesV1 client to send with.
+        conversation_id (str): The unique id for this user and agent.
+        event_type (obj): The BusinessMessagesEvent.EventTypeValueValuesEnum to send.
+
+    Returns:
+       A :bool: True if the event was sent.
+    '''
+    if CIRCUIT_BREAKER.state != CIRCUIT_CLOSED:
+        # Save the struggling API the typing events
+        METRICS.increment('bm_typing_events_dropped_total')
+        return False
+
+    if not RATE_LIMITER.try_acquire_event(conversation_id):
+        # Leave the quota to messages
+        METRICS.increment('bm_typing_events_dropped_total')
+        return False
+
+    def create_event(_):
+        with observe_api_call(API_CALL_EVENT):
+            bm_client.BusinessmessagesV1.ConversationsEventsService(
+                client=client).Create(request=create_event_request(conversation_id, event_type))
+
+    try:
+        # Typing events are not worth retrying
+        RETRY_POLICY.call(create_event, max_attempts=1)
+    except apitools_exceptions.HttpUnauthorizedError:
+        raise
+    except Exception:  # pylint: disable=broad-except
+        # A missing typing indicator is not worth failing the reply for
+        METRICS.increment('bm_typing_events_failed_total')
+        logging.getLogger(__name__).warning('Failed to send %s event', event_type, exc_info=True)
+
+        return False
+
+    return True
 
-    # Send the typing stopped event
-    create_request = BusinessmessagesConversationsEventsCreateRequest(
+def create_event_request(conversation_id, event_type):
+    '''
+    Creates the request to send an event to the user.
+
+    Args:
+        conversation_id (str): The unique id for this user and agent.
+        event_type (obj): The BusinessMessagesEvent.EventTypeValueValuesEnum to send.
+
+    Returns:
+       A :obj: A BusinessmessagesConversationsEventsCreateRequest object.
+    '''
+    return BusinessmessagesConversationsEventsCreateRequest(
         eventId=str(uuid.uuid4().int),
         businessMessagesEvent=BusinessMessagesEvent(
             representative=BOT_REPRESENTATIVE,
-            eventType=BusinessMessagesEvent.EventTypeValueValuesEnum.TYPING_STOPPED
+            eventType=event_type
         ),
         parent='conversations/' + conversation_id)
 
-    bm_client.BusinessmessagesV1.ConversationsEventsService(
-        client=client).Create(request=create_request)
+def is_retryable_error(error):
+    '''
+    Decides whether an outbound call that failed is worth retrying.
+
+    Args:
+        error (Exception): The exception raised by the call.
+
+    Returns:
+       A :bool: True for network errors and transient HTTP statuses.
+    '''
+    if isinstance(error, apitools_exceptions.HttpError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+
+    return isinstance(error, (socket.error, httplib2.HttpLib2Error,
+                              apitools_exceptions.CommunicationError))
+
+@contextlib.contextmanager
+def observe_api_call(call_type, count=1):
+    '''
+    Counts and times the outbound API call made in the block, labelled with
+    its type and with 'ok', the HTTP status of the error or 'error'.
+
+    Args:
+        call_type (str): One of the API_CALL_* constants.
+        count (int): The number of API calls the block makes.
+    '''
+    count_outbound_calls(count)
+    start_time = time.perf_counter()
+    status = 'ok'
+
+    try:
+        yield
+    except apitools_exceptions.HttpError as error:
+        status = str(error.status_code)
+        raise
+    except Exception:
+        status = 'error'
+        raise
+    finally:
+        METRICS.histogram('bm_api_call_seconds', {'call': call_type}).observe(
+            time.perf_counter() - start_time)
+        METRICS.increment('bm_api_calls_total', count,
+                          labels={'call': call_type, 'status': status})
+
+def count_outbound_calls(count):
+    '''
+    Adds API calls to this second's count, shared by every worker on the
+    instance.
+
+    Args:
+        count (int): The number of API calls about to be made.
+    '''
+    SHARED_TABLE.increment('outbound:%d' % int(time.time()), count, OUTBOUND_COUNT_TTL_SECONDS)
+
+def get_outbound_calls_last_second():
+    '''
+    Returns the number of API calls made by every worker on this instance
+    in the last full second.
+
+    Returns:
+       A :int: The number of API calls.
+    '''
+    return SHARED_TABLE.get('outbound:%d' % (int(time.time()) - 1))
 
 def get_sample_carousel():
     '''
@@ -266,12 +1503,13 @@ def get_sample_carousel():
        A :obj: A BusinessMessagesCarouselCard object with three cards.
     '''
     card_content = []
+    suggestions = get_sample_suggestions()
 
     for i, sample_image in enumerate(SAMPLE_IMAGES):
         card_content.append(BusinessMessagesCardContent(
             title='Card #' + str(i),
             description='This is a sample card',
-            suggestions=get_sample_suggestions(),
+            suggestions=suggestions,
             media=BusinessMessagesMedia(
                 height=BusinessMessagesMedia.HeightValueValuesEnum.MEDIUM,
                 contentInfo=BusinessMessagesContentInfo(
@@ -294,23 +1532,30 @@ def get_sample_suggestions():
         BusinessMessagesSuggestion(
             reply=BusinessMessagesSuggestedReply(
                 text='Sample Chip',
-                postbackData='sample_chip')
+                postbackData=POSTBACK_SAMPLE_CHIP)
             ),
         BusinessMessagesSuggestion(
             action=BusinessMessagesSuggestedAction(
                 text='URL Action',
-                postbackData='url_action',
+                postbackData=POSTBACK_URL_ACTION,
                 openUrlAction=BusinessMessagesOpenUrlAction(
                     url='https://www.google.com'))
             ),
         BusinessMessagesSuggestion(
             action=BusinessMessagesSuggestedAction(
                 text='Dial Action',
-                postbackData='dial_action',
+                postbackData=POSTBACK_DIAL_ACTION,
                 dialAction=BusinessMessagesDialAction(
                     phoneNumber='+12223334444'))
             ),
         ]
 
+TOKEN_REFRESHER.ensure_started()
+
+if OUTBOX is not None:
+    OUTBOX.ensure_started()
+
+SHUTDOWN.install()
+
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=8080, debug=True)
@@ -0,0 +1,308 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process counters, gauges and histograms for the echo bot.
+
+The values are kept per worker process and rendered in the Prometheus
+text exposition format by the /metrics endpoint.
+"""
+
+import bisect
+import threading
+import time
+import weakref
+
+# Upper bounds, in seconds, of the histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics(object):
+    '''
+    A thread-safe registry of counters, timings and gauges.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def increment(self, name, value=1, labels=None):
+        '''
+        Adds a value to a counter.
+
+        Args:
+            name (str): The metric name.
+            value (float): The amount to add.
+            labels (dict): Optional label names and values.
+        '''
+        key = (name, _label_key(labels))
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, labels=None):
+        '''
+        Records the duration of an operation as a sum and a count.
+
+        Args:
+            name (str): The metric name, without the _sum/_count suffix.
+            seconds (float): The measured duration.
+            labels (dict): Optional label names and values.
+        '''
+        label_key = _label_key(labels)
+
+        with self._lock:
+            sum_key = (name + '_sum', label_key)
+            count_key = (name + '_count', label_key)
+            self._counters[sum_key] = self._counters.get(sum_key, 0) + seconds
+            self._counters[count_key] = self._counters.get(count_key, 0) + 1
+
+    def register_gauge(self, name, callback):
+        '''
+        Registers a gauge whose value is read when the metrics are rendered.
+
+        Args:
+            name (str): The metric name.
+            callback (callable): Returns the current value of the gauge.
+        '''
+        with self._lock:
+            self._gauges[name] = callback
+
+    def histogram(self, name, labels=None):
+        '''
+        Returns the histogram for a metric name and label set, creating it
+        on first use.
+
+        Args:
+            name (str): The metric name, without the _bucket/_sum/_count suffix.
+            labels (dict): Optional label names and values.
+
+        Returns:
+           A :obj: A Histogram.
+        '''
+        key = (name, _label_key(labels))
+        histogram = self._histograms.get(key)
+
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram(DEFAULT_BUCKETS))
+
+        return histogram
+
+    def time(self, name, labels=None):
+        '''
+        Returns a context manager that observes how long its block takes.
+
+        Args:
+            name (str): The histogram name.
+            labels (dict): Optional label names and values.
+
+        Returns:
+           A :obj: A context manager.
+        '''
+        return _Timer(self.histogram(name, labels))
+
+    def get(self, name, labels=None):
+        '''
+        Returns the current value of a counter.
+
+        Args:
+            name (str): The metric name.
+            labels (dict): Optional label names and values.
+
+        Returns:
+           A :float: The counter value, or 0 if it was never incremented.
+        '''
+        with self._lock:
+            return self._counters.get((name, _label_key(labels)), 0)
+
+    def render(self):
+        '''
+        Renders every metric in the Prometheus text exposition format.
+
+        Returns:
+           A :str: One line per metric value.
+        '''
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted(self._histograms.items())
+
+        lines = []
+
+        for (name, label_key), value in counters:
+            lines.append('%s%s %s' % (name, _format_labels(label_key), _format_value(value)))
+
+        for (name, label_key), histogram in histograms:
+            bucket_counts, total, count = histogram.snapshot()
+            cumulative_count = 0
+
+            for upper_bound, bucket_count in zip(histogram.upper_bounds + ('+Inf',), bucket_counts):
+                cumulative_count += bucket_count
+                lines.append('%s_bucket%s %s' % (
+                    name, _format_labels(label_key + (('le', upper_bound),)), cumulative_count))
+
+            lines.append('%s_sum%s %s' % (name, _format_labels(label_key), repr(total)))
+            lines.append('%s_count%s %s' % (name, _format_labels(label_key), count))
+
+        for name, callback in gauges:
+            try:
+                value = callback()
+            except Exception:  # pylint: disable=broad-except
+                continue
+
+            lines.append('%s %s' % (name, _format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+class Histogram(object):
+    '''
+    Counts observations in fixed buckets.
+
+    Each thread counts into its own shard, so observing takes no lock; the
+    shards are only added up when the histogram is rendered. The shard of a
+    thread that exits is folded into a retired total and dropped.
+    '''
+
+    def __init__(self, upper_bounds):
+        '''
+        Args:
+            upper_bounds (tuple): The sorted upper bounds of the buckets. A
+                final bucket catches anything larger.
+        '''
+        self.upper_bounds = tuple(upper_bounds)
+        self._local = threading.local()
+        self._shards = {}
+        self._retired = [0] * (len(self.upper_bounds) + 1) + [0.0]
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        '''
+        Records one observation.
+
+        Args:
+            value (float): The observed value.
+        '''
+        shard = getattr(self._local, 'shard', None)
+
+        if shard is None:
+            shard = self._add_shard()
+
+        # One count per bucket, then the sum of all observations
+        shard[bisect.bisect_left(self.upper_bounds, value)] += 1
+        shard[-1] += value
+
+    def snapshot(self):
+        '''
+        Adds up the shards of every thread.
+
+        Returns:
+           A :tuple: The count in each bucket, the sum of the observations
+           and the number of observations.
+        '''
+        with self._lock:
+            shards = list(self._shards.values())
+            totals = list(self._retired)
+
+        for shard in shards:
+            for index, value in enumerate(shard):
+                totals[index] += value
+
+        bucket_counts = totals[:-1]
+
+        return bucket_counts, float(totals[-1]), sum(bucket_counts)
+
+    def _add_shard(self):
+        '''
+        Creates the calling thread's shard.
+        '''
+        shard = [0] * (len(self.upper_bounds) + 1) + [0.0]
+        owner = _ShardOwner()
+        self._local.shard = shard
+        self._local.owner = owner
+
+        with self._lock:
+            self._shards[id(shard)] = shard
+
+        # The thread's locals, and so the owner, are deleted when it exits
+        weakref.finalize(owner, self._retire_shard, shard)
+
+        return shard
+
+    def _retire_shard(self, shard):
+        '''
+        Folds the shard of a thread that exited into the retired total.
+        '''
+        with self._lock:
+            del self._shards[id(shard)]
+
+            for index, value in enumerate(shard):
+                self._retired[index] += value
+
+class _ShardOwner(object):
+    '''
+    Held only by a thread's locals, so it is freed when the thread exits.
+    '''
+
+    __slots__ = ('__weakref__',)
+
+class _Timer(object):
+    '''
+    Context manager observing the duration of its block in a histogram.
+    '''
+
+    __slots__ = ('_histogram', '_start_time')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+        self._start_time = None
+
+    def __enter__(self):
+        self._start_time = time.perf_counter()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.observe(time.perf_counter() - self._start_time)
+
+def _label_key(labels):
+    '''
+    Converts a label dict into a hashable, ordered tuple.
+    '''
+    if not labels:
+        return ()
+
+    return tuple(sorted(labels.items()))
+
+def _format_labels(label_key):
+    '''
+    Formats a label tuple as a Prometheus label set.
+    '''
+    if not label_key:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, value) for name, value in label_key)
+
+def _format_value(value):
+    '''
+    Formats a metric value, keeping integers free of a decimal point.
+    '''
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+
+    return str(int(value))
+
+# The metrics shared by every module in this worker
+METRICS = Metrics()
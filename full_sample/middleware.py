@@ -0,0 +1,215 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""WSGI middleware that answers cheap webhooks before they reach Flask.
+
+Forged requests and events the bot does not reply to, such as typing and
+read receipts, would otherwise pay for full Flask request handling and
+JSON parsing. WebhookFilter reads the raw body once, checks its signature
+and looks for the event type in the first bytes of the body, answering
+those requests itself. Everything else is passed on to Flask with the
+body it already read, once the admission controller, if any, lets it in.
+"""
+
+import base64
+import binascii
+import hashlib
+import hmac
+import io
+import json
+import re
+
+from admission import PRIORITY_HIGH, PRIORITY_LOW
+from metrics import METRICS
+
+# Keys of events that need no handling: typing statuses and read receipts.
+# Other user statuses, such as live agent requests, reach the app. Only keys
+# are followed by a colon, and quotes inside message text are escaped, so
+# the same words inside message text do not match.
+_NO_REPLY_EVENT = re.compile(rb'"(isTyping|receipts)"\s*:')
+
+# Top-level keys of webhooks sent by the user, which are admitted first
+_USER_MESSAGE = re.compile(rb'"(message|suggestionResponse)"\s*:')
+
+# The longest unsigned body accepted; only webhook verification requests,
+# which are a few dozen bytes, are sent unsigned
+_UNSIGNED_MAX_BYTES = 1024
+
+class SignatureVerifier(object):
+    '''
+    Checks the x-goog-signature of webhooks, an HMAC-SHA512 of the request
+    body keyed with the partner key.
+
+    The keys are hashed into HMAC objects once, and each request copies
+    them instead of starting from the raw key again.
+    '''
+
+    def __init__(self, partner_keys):
+        '''
+        Args:
+            partner_keys (list): The partner keys that webhooks may be signed with.
+        '''
+        self._prepared_macs = [
+            hmac.new(partner_key.encode('utf-8'), digestmod=hashlib.sha512)
+            for partner_key in partner_keys]
+
+    def verify(self, body, signature):
+        '''
+        Checks a signature against every partner key in constant time.
+
+        Args:
+            body (bytes): The raw request body.
+            signature (str): The base64 encoded x-goog-signature header.
+
+        Returns:
+           A :bool: True if the body was signed with one of the partner keys.
+        '''
+        try:
+            expected_digest = base64.b64decode(signature, validate=True)
+        except (binascii.Error, ValueError):
+            return False
+
+        valid = False
+
+        # Check every key, so the time taken does not reveal which one matched
+        for prepared_mac in self._prepared_macs:
+            mac = prepared_mac.copy()
+            mac.update(body)
+            valid |= hmac.compare_digest(mac.digest(), expected_digest)
+
+        return valid
+
+    def check(self, body, signature):
+        '''
+        Checks a webhook, which must be signed unless it is a webhook
+        verification request.
+
+        Args:
+            body (bytes): The raw request body.
+            signature (str): The x-goog-signature header, or None if it is
+                missing.
+
+        Returns:
+           A :str: Why the webhook is rejected, 'unsigned' or
+           'invalid_signature', or None if it is accepted.
+        '''
+        if signature is None:
+            return None if _is_verification_request(body) else 'unsigned'
+
+        with METRICS.time('bm_stage_seconds', {'stage': 'verify'}):
+            is_valid = self.verify(body, signature)
+
+        return None if is_valid else 'invalid_signature'
+
+class WebhookFilter(object):
+    '''
+    Wraps a WSGI application, answering invalid webhooks and webhooks that
+    need no reply without calling it.
+    '''
+
+    def __init__(self, wsgi_app, path, verifier, max_body_bytes, sniff_bytes,
+                 admission=None, retry_after_seconds=1):
+        '''
+        Args:
+            wsgi_app (callable): The WSGI application to wrap.
+            path (str): The webhook path. Other requests are passed through.
+            verifier (obj): The SignatureVerifier to check webhooks with, or
+                None to accept unsigned webhooks.
+            max_body_bytes (int): The largest webhook body accepted.
+            sniff_bytes (int): How far into the body to look for the event type.
+            admission (obj): The AdmissionController that limits the webhooks
+                passed on at once, or None for no limit.
+            retry_after_seconds (int): The Retry-After sent with webhooks
+                that are shed.
+        '''
+        self._wsgi_app = wsgi_app
+        self._path = path
+        self._verifier = verifier
+        self._max_body_bytes = max_body_bytes
+        self._sniff_bytes = sniff_bytes
+        self._admission = admission
+        self._retry_after = str(retry_after_seconds)
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') != self._path or environ.get('REQUEST_METHOD') != 'POST':
+            return self._wsgi_app(environ, start_response)
+
+        # Read one byte past the limit to tell a body that is too large
+        body = environ['wsgi.input'].read(self._max_body_bytes + 1)
+
+        if len(body) > self._max_body_bytes:
+            return self._reject(start_response, '413 Payload Too Large', 'too_large')
+
+        if self._verifier is not None:
+            reason = self._verifier.check(body, environ.get('HTTP_X_GOOG_SIGNATURE'))
+
+            if reason is not None:
+                return self._reject(start_response, '403 Forbidden', reason)
+
+        match = _NO_REPLY_EVENT.search(body, 0, self._sniff_bytes)
+
+        if match is not None:
+            METRICS.increment('bm_webhook_filtered_total',
+                              labels={'event': match.group(1).decode('ascii')})
+            start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8'),
+                                      ('Content-Length', '0')])
+            return [b'']
+
+        # Hand the body that was already read on to the application
+        environ['wsgi.input'] = io.BytesIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+
+        if self._admission is None:
+            return self._wsgi_app(environ, start_response)
+
+        priority = (PRIORITY_HIGH if _USER_MESSAGE.search(body, 0, self._sniff_bytes)
+                    else PRIORITY_LOW)
+
+        with METRICS.time('bm_stage_seconds', {'stage': 'admission'}):
+            admitted = self._admission.acquire(priority)
+
+        if not admitted:
+            start_response('503 Service Unavailable', [
+                ('Content-Type', 'text/plain'), ('Content-Length', '0'),
+                ('Retry-After', self._retry_after)])
+            return [b'']
+
+        try:
+            return self._wsgi_app(environ, start_response)
+        finally:
+            self._admission.release()
+
+    def _reject(self, start_response, status, reason):
+        '''
+        Answers a webhook that is not accepted.
+        '''
+        METRICS.increment('bm_webhook_rejected_total', labels={'reason': reason})
+        start_response(status, [('Content-Type', 'text/plain'), ('Content-Length', '0')])
+
+        return [b'']
+
+def _is_verification_request(body):
+    '''
+    Checks whether an unsigned body is a webhook verification request, the
+    only kind of webhook that is not signed.
+    '''
+    if len(body) > _UNSIGNED_MAX_BYTES:
+        return False
+
+    try:
+        request_body = json.loads(body)
+    except ValueError:
+        return False
+
+    return isinstance(request_body, dict) and 'secret' in request_body
@@ -0,0 +1,414 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A durable local outbox for replies that are sent in the background.
+
+Each acknowledged webhook is written to a SQLite database in WAL mode
+before the acknowledgement is sent, the reply is added once it is built,
+and the entry is deleted once the reply has been sent.
+
+Each worker process owns the entries it writes, under an id made of a
+random boot id and its pid, so a pid reused after a restart is never
+mistaken for the old owner. Owners renew a lease on a timer. Every worker
+rescans the outbox on the same timer, takes over the entries of owners
+whose lease has run out and replays them, and retries its own entries
+whose send failed until they are too old.
+
+Writes are made by one thread per process, which commits everything that
+is waiting in a single transaction, each write under its own savepoint so
+one that fails does not fail the others. Callers that need their write to be
+durable wait for that commit, so under load many writes share each one.
+"""
+
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+from metrics import METRICS
+
+# The most writes committed in one transaction
+_MAX_BATCH = 256
+
+# How long to wait for another process holding the database lock
+_BUSY_TIMEOUT_SECONDS = 5
+
+# How many times each lease is renewed before it runs out
+_RENEWALS_PER_LEASE = 3
+
+# Creates or renews the lease of an owner
+_RENEW_LEASE = 'INSERT OR REPLACE INTO outbox_owners (owner, lease_expires) VALUES (?, ?)'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox_entries (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    created REAL NOT NULL,
+    conversation_id TEXT NOT NULL,
+    message TEXT,
+    postback_data TEXT,
+    reply BLOB
+);
+CREATE TABLE IF NOT EXISTS outbox_owners (
+    owner TEXT PRIMARY KEY,
+    lease_expires REAL NOT NULL
+);
+'''
+
+class OutboxEntry(object):
+    '''
+    A reply that was not known to be sent when its worker process stopped,
+    or whose send failed.
+    '''
+
+    __slots__ = ('entry_id', 'conversation_id', 'message', 'postback_data', 'reply')
+
+    def __init__(self, entry_id, conversation_id, message, postback_data, reply):
+        '''
+        Args:
+            entry_id (str): The id of the outbox entry.
+            conversation_id (str): The unique id for this user and agent.
+            message (str): The message text received from the user.
+            postback_data (str): The postbackData of the suggestion the user
+                tapped, if any.
+            reply (bytes): The JSON encoded reply, or None if it was not
+                built yet.
+        '''
+        self.entry_id = entry_id
+        self.conversation_id = conversation_id
+        self.message = message
+        self.postback_data = postback_data
+        self.reply = reply
+
+class Outbox(object):
+    '''
+    Records replies until they are sent, in a database shared by every
+    worker process on the instance.
+    '''
+
+    def __init__(self, path, max_age_seconds, lease_seconds, replay):
+        '''
+        Args:
+            path (str): The SQLite database file.
+            max_age_seconds (float): How old an entry may be and still be
+                replayed. Older ones are discarded.
+            lease_seconds (float): How long the entries of a worker process
+                that stops renewing its lease are left before another one
+                takes them over. The outbox is rescanned three times as often.
+            replay (callable): Called with each OutboxEntry taken over from
+                a worker process that stopped, or whose send failed. It
+                should queue the send rather than make it, and must call
+                remove() once the reply is sent, or release() if the send
+                fails or cannot be queued.
+        '''
+        self._path = path
+        self._max_age_seconds = max_age_seconds
+        self._lease_seconds = lease_seconds
+        self._replay = replay
+        self._writes = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._owner = None
+        self._pending = 0
+        self._failed = set()
+
+        METRICS.register_gauge('bm_outbox_pending', lambda: self._pending)
+
+    def add(self, conversation_id, message, postback_data=None):
+        '''
+        Records a reply that is still to be built and sent, returning once
+        the record is durable.
+
+        Args:
+            conversation_id (str): The unique id for this user and agent.
+            message (str): The message text received from the user.
+            postback_data (str): The postbackData of the suggestion the user
+                tapped, if any.
+
+        Returns:
+           A :str: The id of the new entry.
+        '''
+        entry_id = uuid.uuid4().hex
+        self._write(
+            'INSERT INTO outbox_entries'
+            ' (id, owner, created, conversation_id, message, postback_data)'
+            ' VALUES (?, ?, ?, ?, ?, ?)',
+            (entry_id, self._owner, time.time(), conversation_id, message, postback_data),
+            wait=True)
+
+        with self._lock:
+            self._pending += 1
+
+        return entry_id
+
+    def set_reply(self, entry_id, reply):
+        '''
+        Records the reply built for an entry, returning once the record is
+        durable, so a replay sends the same reply with the same messageId.
+
+        Args:
+            entry_id (str): The id returned by add().
+            reply (bytes): The JSON encoded reply.
+        '''
+        self._write('UPDATE outbox_entries SET reply = ? WHERE id = ?', (reply, entry_id),
+                    wait=True)
+
+    def remove(self, entry_id):
+        '''
+        Deletes an entry whose reply was sent. Does not wait for the commit;
+        if it is lost, the replay of the reply is recognised by the API.
+
+        Args:
+            entry_id (str): The id returned by add().
+        '''
+        self._write('DELETE FROM outbox_entries WHERE id = ?', (entry_id,), wait=False)
+
+        with self._lock:
+            self._pending -= 1
+
+    def release(self, entry_id):
+        '''
+        Hands back an entry whose send failed, so a later rescan replays it
+        until it is too old.
+
+        Args:
+            entry_id (str): The id returned by add().
+        '''
+        with self._lock:
+            self._failed.add(entry_id)
+
+    def ensure_started(self):
+        '''
+        Takes a lease and starts the writer thread, the thread that renews
+        the lease and the thread that rescans the outbox, unless this
+        process already did.
+        '''
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._writes = queue.Queue()
+                self._owner = '%s-%d' % (uuid.uuid4().hex, os.getpid())
+                self._pending = 0
+                self._failed = set()
+                # Queued first, so the lease is committed before any entry
+                self._writes.put([_RENEW_LEASE, self._lease_parameters(), None, None])
+                threading.Thread(target=self._run_writer, name='outbox-writer',
+                                 daemon=True).start()
+                threading.Thread(target=self._run_lease, name='outbox-lease',
+                                 daemon=True).start()
+                threading.Thread(target=self._run_rescan, name='outbox-rescan',
+                                 daemon=True).start()
+                self._pid = os.getpid()
+
+    def _lease_parameters(self):
+        '''
+        Returns the parameters of the statement renewing this process' lease.
+        '''
+        return (self._owner, time.time() + self._lease_seconds)
+
+    def _write(self, statement, parameters, wait):
+        '''
+        Queues a write for the writer thread, optionally waiting until it
+        is committed.
+        '''
+        self.ensure_started()
+
+        done = threading.Event() if wait else None
+        write = [statement, parameters, done, None]
+        self._writes.put(write)
+
+        if done is not None:
+            done.wait()
+
+            if write[3] is not None:
+                raise write[3]
+
+    def _connect(self):
+        '''
+        Opens the database, creating it if needed.
+        '''
+        connection = sqlite3.connect(self._path, timeout=_BUSY_TIMEOUT_SECONDS,
+                                     isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # A commit in WAL mode survives the process crashing, which is what
+        # the outbox protects against, without an fsync per transaction
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(_SCHEMA)
+
+        return connection
+
+    def _run_writer(self):
+        '''
+        Commits the queued writes, as many as are waiting in each transaction.
+        '''
+        try:
+            connection = self._connect()
+            connect_error = None
+        except sqlite3.Error as e:
+            connection = None
+            connect_error = e
+            logging.getLogger(__name__).exception('Failed to open the outbox')
+
+        while True:
+            writes = [self._writes.get()]
+
+            while len(writes) < _MAX_BATCH:
+                try:
+                    writes.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+
+            start_time = time.perf_counter()
+
+            try:
+                if connection is None:
+                    raise connect_error
+
+                connection.execute('BEGIN IMMEDIATE')
+
+                for write in writes:
+                    self._execute(connection, write)
+
+                connection.execute('COMMIT')
+            except sqlite3.Error as e:
+                METRICS.increment('bm_outbox_commit_failures_total')
+                logging.getLogger(__name__).exception('Failed to commit outbox writes')
+
+                if connection is not None and connection.in_transaction:
+                    connection.execute('ROLLBACK')
+
+                for write in writes:
+                    write[3] = e
+
+            METRICS.observe('bm_outbox_commit_seconds', time.perf_counter() - start_time)
+            METRICS.increment('bm_outbox_writes_total', len(writes))
+
+            for write in writes:
+                if write[2] is not None:
+                    write[2].set()
+
+    @staticmethod
+    def _execute(connection, write):
+        '''
+        Runs one write of a group commit under its own savepoint, so a write
+        that fails is undone without failing the others.
+        '''
+        statement, parameters, _, _ = write
+        connection.execute('SAVEPOINT outbox_write')
+
+        try:
+            connection.execute(statement, parameters)
+        except sqlite3.Error as e:
+            write[3] = e
+            connection.execute('ROLLBACK TO outbox_write')
+            METRICS.increment('bm_outbox_write_failures_total')
+            logging.getLogger(__name__).exception('Failed to write to the outbox')
+
+        connection.execute('RELEASE outbox_write')
+
+    def _run_lease(self):
+        '''
+        Renews this process' lease on a timer, on its own thread so a slow
+        rescan cannot let the lease run out while the process is alive.
+        '''
+        while True:
+            time.sleep(self._lease_seconds / _RENEWALS_PER_LEASE)
+            self._write(_RENEW_LEASE, self._lease_parameters(), wait=False)
+
+    def _run_rescan(self):
+        '''
+        Rescans the outbox on a timer.
+        '''
+        while True:
+            try:
+                self._rescan()
+            except Exception:  # pylint: disable=broad-except
+                logging.getLogger(__name__).exception('Failed to rescan the outbox')
+
+            time.sleep(self._lease_seconds / _RENEWALS_PER_LEASE)
+
+    def _rescan(self):
+        '''
+        Takes over the entries of worker processes whose lease ran out,
+        discards the entries to replay that are too old and replays the rest.
+        '''
+        with self._lock:
+            failed_ids = list(self._failed)
+            self._failed.difference_update(failed_ids)
+
+        now = time.time()
+        expire_before = now - self._max_age_seconds
+        connection = None
+
+        try:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('DELETE FROM outbox_owners WHERE lease_expires < ?', (now,))
+            # Never this process' own entries, even if its lease was late
+            stale_owners = 'owner != ? AND owner NOT IN (SELECT owner FROM outbox_owners)'
+            expired = connection.execute(
+                'DELETE FROM outbox_entries WHERE created < ? AND ' + stale_owners,
+                (expire_before, self._owner)).rowcount
+            entries = [OutboxEntry(*row) for row in connection.execute(
+                'SELECT id, conversation_id, message, postback_data, reply FROM outbox_entries'
+                ' WHERE ' + stale_owners + ' ORDER BY created', (self._owner,))]
+            claimed = len(entries)
+            connection.execute('UPDATE outbox_entries SET owner = ? WHERE ' + stale_owners,
+                               (self._owner, self._owner))
+
+            for entry_id in failed_ids:
+                row = connection.execute(
+                    'SELECT id, conversation_id, message, postback_data, reply, created'
+                    ' FROM outbox_entries WHERE id = ? AND owner = ?',
+                    (entry_id, self._owner)).fetchone()
+
+                if row is None:
+                    # Another process took the entry over while this one's lease was late
+                    continue
+
+                if row[5] < expire_before:
+                    connection.execute('DELETE FROM outbox_entries WHERE id = ?', (entry_id,))
+                    expired += 1
+                else:
+                    entries.append(OutboxEntry(*row[:5]))
+
+            connection.execute('COMMIT')
+        except sqlite3.Error:
+            logging.getLogger(__name__).exception('Failed to rescan the outbox')
+
+            with self._lock:
+                self._failed.update(failed_ids)
+            return
+        finally:
+            if connection is not None:
+                connection.close()
+
+        METRICS.increment('bm_outbox_expired_total', expired)
+
+        with self._lock:
+            # The failed entries that were not replayed have left this process
+            self._pending += claimed - (len(failed_ids) - (len(entries) - claimed))
+
+        for entry in entries:
+            METRICS.increment('bm_outbox_replayed_total')
+
+            try:
+                self._replay(entry)
+            except Exception:  # pylint: disable=broad-except
+                logging.getLogger(__name__).exception('Failed to replay outbox entry')
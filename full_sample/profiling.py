@@ -0,0 +1,222 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in profiling of individual webhook requests.
+
+A profiled request runs under cProfile, and a background thread samples
+its call stack every few milliseconds. The results of every profiled
+request are added up in memory and can be dumped as pstats data, as
+pstats text or as collapsed stacks for flame graph tools.
+
+When no requests are sampled and no admin token is set, the profiler is
+disabled and costs one attribute check per request.
+"""
+
+import collections
+import cProfile
+import hmac
+import io
+import itertools
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+
+class RequestProfiler(object):
+    '''
+    Profiles one in every N requests, and requests made with the admin token.
+    '''
+
+    def __init__(self, sample_every, admin_token, sample_interval_seconds):
+        '''
+        Args:
+            sample_every (int): Profile one in this many requests; 0 for none.
+            admin_token (str): The token that forces a request to be profiled
+                and that is required to read the results, or None.
+            sample_interval_seconds (float): How often the call stacks of
+                profiled requests are sampled.
+        '''
+        self.enabled = bool(sample_every or admin_token)
+        self._sample_every = sample_every
+        self._admin_token = admin_token
+        self._sample_interval_seconds = sample_interval_seconds
+        self._request_counter = itertools.count(1)
+        self._lock = threading.Lock()
+        self._stats = None
+        self._stacks = collections.Counter()
+        self._profiled_requests = 0
+        self._sampled_threads = set()
+        self._sampling = threading.Event()
+        self._sampler_pid = None
+
+    def is_admin(self, token):
+        '''
+        Checks a token against the admin token in constant time.
+
+        Args:
+            token (str): The token sent with the request, or None.
+
+        Returns:
+           A :bool: True if an admin token is set and the token matches it.
+        '''
+        if not self._admin_token or token is None:
+            return False
+
+        return hmac.compare_digest(token.encode('utf-8'), self._admin_token.encode('utf-8'))
+
+    def start(self, admin_token=None):
+        '''
+        Starts profiling the request handled by the calling thread if it is
+        sampled or carries the admin token.
+
+        Args:
+            admin_token (str): The admin token sent with the request, or None.
+
+        Returns:
+           A :obj: The cProfile.Profile to pass to stop(), or None if the
+           request is not profiled.
+        '''
+        sampled = self._sample_every and next(self._request_counter) % self._sample_every == 0
+
+        if not sampled and not self.is_admin(admin_token):
+            return None
+
+        profile = cProfile.Profile()
+
+        try:
+            profile.enable()
+        except ValueError:
+            # Only one profiler can run at a time on some Python versions
+            return None
+
+        self._ensure_sampler_started()
+
+        with self._lock:
+            self._sampled_threads.add(threading.get_ident())
+            self._sampling.set()
+
+        return profile
+
+    def stop(self, profile):
+        '''
+        Stops profiling the calling thread's request and adds its results.
+
+        Args:
+            profile (obj): The cProfile.Profile returned by start().
+        '''
+        profile.disable()
+
+        with self._lock:
+            self._sampled_threads.discard(threading.get_ident())
+
+            if not self._sampled_threads:
+                self._sampling.clear()
+
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+
+            self._profiled_requests += 1
+
+    def dump(self, output_format, limit=50):
+        '''
+        Renders the results of every profiled request so far.
+
+        Args:
+            output_format (str): 'pstats' for data that pstats and tools such
+                as snakeviz load, 'text' for the pstats report sorted by
+                cumulative time, or 'collapsed' for one line per sampled
+                stack, as read by flamegraph.pl and speedscope.
+            limit (int): The most functions listed in the text report.
+
+        Returns:
+           A :bytes: The rendered results.
+
+        Raises:
+            ValueError: If the format is not known.
+        '''
+        with self._lock:
+            if output_format == 'collapsed':
+                return ''.join('%s %d\n' % (stack, count)
+                               for stack, count in self._stacks.items()).encode('utf-8')
+
+            if output_format == 'pstats':
+                return marshal.dumps(self._stats.stats if self._stats is not None else {})
+
+            if output_format == 'text':
+                output = io.StringIO()
+                output.write('%d profiled requests\n' % self._profiled_requests)
+
+                if self._stats is not None:
+                    self._stats.stream = output
+                    self._stats.sort_stats('cumulative').print_stats(limit)
+
+                return output.getvalue().encode('utf-8')
+
+        raise ValueError('Unknown profile format: %s' % output_format)
+
+    def reset(self):
+        '''
+        Discards the results collected so far.
+        '''
+        with self._lock:
+            self._stats = None
+            self._stacks.clear()
+            self._profiled_requests = 0
+
+    def _ensure_sampler_started(self):
+        '''
+        Starts the stack sampling thread if this process does not have one yet.
+        '''
+        if self._sampler_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._sampler_pid != os.getpid():
+                threading.Thread(target=self._sample, name='request-profiler',
+                                 daemon=True).start()
+                self._sampler_pid = os.getpid()
+
+    def _sample(self):
+        '''
+        Records the call stack of every profiled request, while there are any.
+        '''
+        while True:
+            self._sampling.wait()
+            time.sleep(self._sample_interval_seconds)
+
+            with self._lock:
+                thread_ids = list(self._sampled_threads)
+
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            stacks = [_collapse_stack(frames[thread_id])
+                      for thread_id in thread_ids if thread_id in frames]
+
+            with self._lock:
+                self._stacks.update(stacks)
+
+def _collapse_stack(frame):
+    '''
+    Formats a call stack, outermost frame first, separated by semicolons.
+    '''
+    names = []
+
+    while frame is not None:
+        names.append('%s.%s' % (frame.f_globals.get('__name__', '?'), frame.f_code.co_name))
+        frame = frame.f_back
+
+    return ';'.join(reversed(names))
@@ -0,0 +1,264 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Client-side rate limiting of outbound API calls.
+
+Messages and events are drawn from separate token buckets, and each
+conversation can have a bucket of its own. A message waits for a token,
+while an event that finds no token is dropped, so a burst of webhooks
+loses typing indicators before it delays any replies.
+
+Waiting is done by reservation: a caller takes a token that will only
+exist in the future and sleeps until then outside the lock, so callers
+are released in order at the configured rate.
+"""
+
+import collections
+import threading
+import time
+
+from metrics import METRICS
+
+# Call types, as used in metric labels
+CALL_MESSAGE = 'message'
+CALL_EVENT = 'event'
+
+class ThrottledError(Exception):
+    '''
+    Raised when a message would have to wait too long for a token.
+    '''
+
+class TokenBucket(object):
+    '''
+    Hands out tokens at a steady rate, saving up to a burst of them.
+    '''
+
+    def __init__(self, rate, burst):
+        '''
+        Args:
+            rate (float): The tokens added per second.
+            burst (float): The most tokens that can be saved up.
+        '''
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self):
+        '''
+        The tokens available now. Negative while callers wait for tokens
+        they have reserved.
+        '''
+        with self._lock:
+            self._refill()
+
+            return self._tokens
+
+    def try_acquire(self, reserve=0):
+        '''
+        Takes a token if one is available now, leaving at least reserve
+        tokens behind.
+
+        Args:
+            reserve (float): Tokens that must remain for other callers.
+
+        Returns:
+           A :bool: True if a token was taken.
+        '''
+        with self._lock:
+            self._refill()
+
+            if self._tokens < 1 + reserve:
+                return False
+
+            self._tokens -= 1
+
+            return True
+
+    def reserve(self, max_wait_seconds):
+        '''
+        Takes a token, which may only become available in the future.
+
+        Args:
+            max_wait_seconds (float): The longest acceptable wait.
+
+        Returns:
+           A :float: How long to wait before using the token, or None if
+           that would be longer than max_wait_seconds and no token was taken.
+        '''
+        with self._lock:
+            self._refill()
+            wait_seconds = max(0, (1 - self._tokens) / self._rate)
+
+            if wait_seconds > max_wait_seconds:
+                return None
+
+            self._tokens -= 1
+
+            return wait_seconds
+
+    def refund(self):
+        '''
+        Returns a token that was taken but not used.
+        '''
+        with self._lock:
+            self._tokens = min(self._tokens + 1, self._burst)
+
+    def _refill(self):
+        '''
+        Adds the tokens earned since the last update. Must be called with
+        the lock held.
+        '''
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._updated) * self._rate, self._burst)
+        self._updated = now
+
+class OutboundRateLimiter(object):
+    '''
+    Shapes the outbound calls of one worker process. A rate of 0 leaves
+    that kind of call unlimited.
+    '''
+
+    def __init__(self, message_rate, event_rate, conversation_rate, burst_seconds,
+                 max_wait_seconds, max_conversations):
+        '''
+        Args:
+            message_rate (float): The messages sent per second.
+            event_rate (float): The events sent per second.
+            conversation_rate (float): The calls of either type made per
+                second for each conversation.
+            burst_seconds (float): How many seconds of calls can be made at
+                once after a quiet period.
+            max_wait_seconds (float): The longest a message waits for a token.
+            max_conversations (int): The most conversations tracked at once.
+                The least recently used are forgotten first.
+        '''
+        self._message_bucket = _create_bucket(message_rate, burst_seconds)
+        self._event_bucket = _create_bucket(event_rate, burst_seconds)
+        self._conversation_rate = conversation_rate
+        self._burst_seconds = burst_seconds
+        self._max_wait_seconds = max_wait_seconds
+        self._max_conversations = max_conversations
+        self._conversation_buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._message_wait_histogram = METRICS.histogram(
+            'bm_rate_limit_wait_seconds', {'call': CALL_MESSAGE})
+
+        if self._message_bucket is not None:
+            METRICS.register_gauge('bm_rate_limit_message_tokens',
+                                   lambda: self._message_bucket.tokens)
+
+        if self._event_bucket is not None:
+            METRICS.register_gauge('bm_rate_limit_event_tokens',
+                                   lambda: self._event_bucket.tokens)
+
+    def acquire_message(self, conversation_id):
+        '''
+        Waits until a message may be sent to a conversation.
+
+        Args:
+            conversation_id (str): The unique id for this user and agent.
+
+        Raises:
+            ThrottledError: If the wait would be longer than max_wait_seconds.
+        '''
+        buckets = [bucket for bucket in (self._get_conversation_bucket(conversation_id),
+                                         self._message_bucket) if bucket is not None]
+
+        if not buckets:
+            return
+
+        wait_seconds = 0
+
+        for index, bucket in enumerate(buckets):
+            bucket_wait_seconds = bucket.reserve(self._max_wait_seconds)
+
+            if bucket_wait_seconds is None:
+                for reserved_bucket in buckets[:index]:
+                    reserved_bucket.refund()
+
+                METRICS.increment('bm_rate_limited_total',
+                                  labels={'call': CALL_MESSAGE, 'outcome': 'rejected'})
+                raise ThrottledError('Too many messages are waiting to be sent')
+
+            wait_seconds = max(wait_seconds, bucket_wait_seconds)
+
+        self._message_wait_histogram.observe(wait_seconds)
+
+        if wait_seconds:
+            METRICS.increment('bm_rate_limited_total',
+                              labels={'call': CALL_MESSAGE, 'outcome': 'delayed'})
+            time.sleep(wait_seconds)
+
+    def try_acquire_event(self, conversation_id):
+        '''
+        Decides whether an event may be sent to a conversation now. An event
+        never takes a conversation's last token, which is kept for a message.
+
+        Args:
+            conversation_id (str): The unique id for this user and agent.
+
+        Returns:
+           A :bool: True if the event may be sent, False if it should be dropped.
+        '''
+        conversation_bucket = self._get_conversation_bucket(conversation_id)
+
+        if conversation_bucket is not None and not conversation_bucket.try_acquire(reserve=1):
+            METRICS.increment('bm_rate_limited_total',
+                              labels={'call': CALL_EVENT, 'outcome': 'dropped'})
+            return False
+
+        if self._event_bucket is not None and not self._event_bucket.try_acquire():
+            if conversation_bucket is not None:
+                conversation_bucket.refund()
+
+            METRICS.increment('bm_rate_limited_total',
+                              labels={'call': CALL_EVENT, 'outcome': 'dropped'})
+            return False
+
+        return True
+
+    def _get_conversation_bucket(self, conversation_id):
+        '''
+        Returns the bucket of a conversation, or None if conversations are
+        not limited.
+        '''
+        if not self._conversation_rate:
+            return None
+
+        with self._lock:
+            bucket = self._conversation_buckets.get(conversation_id)
+
+            if bucket is None:
+                bucket = _create_bucket(self._conversation_rate, self._burst_seconds)
+                self._conversation_buckets[conversation_id] = bucket
+
+                if len(self._conversation_buckets) > self._max_conversations:
+                    self._conversation_buckets.popitem(last=False)
+            else:
+                self._conversation_buckets.move_to_end(conversation_id)
+
+            return bucket
+
+def _create_bucket(rate, burst_seconds):
+    '''
+    Creates a bucket for a rate, or returns None if the rate is unlimited.
+    A bucket always holds at least one token.
+    '''
+    if not rate:
+        return None
+
+    return TokenBucket(rate, max(rate * burst_seconds, 1))
@@ -0,0 +1,184 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Logging that stays off the request thread, and per-request stage timings.
+
+AsyncLogHandler puts each record on a bounded queue as it is, and a
+background thread formats and writes it, so a slow log sink never holds
+up a webhook. Records are dropped, and counted, when the queue is full.
+
+start_request, lap and finish_request time the stages of the request
+handled by the calling thread, for the one-line access log written once
+the response is ready.
+"""
+
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+from metrics import METRICS
+
+# The format of unstructured log lines, matching Flask's default
+_TEXT_FORMAT = '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
+
+# The stage timings of the request handled by each thread
+_local = threading.local()
+
+class LogFormatter(logging.Formatter):
+    '''
+    Formats records as text, or as one JSON object per line that Cloud
+    Logging reads as structured entries. Fields passed with
+    extra={'fields': {...}} are appended to the text or merged into the
+    JSON object.
+    '''
+
+    def __init__(self, structured):
+        '''
+        Args:
+            structured (bool): Whether to write JSON instead of text.
+        '''
+        super(LogFormatter, self).__init__(_TEXT_FORMAT)
+        self._structured = structured
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None)
+
+        if not self._structured:
+            text = super(LogFormatter, self).format(record)
+
+            return text if fields is None else text + ' ' + json.dumps(fields)
+
+        entry = {
+            'time': datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc).isoformat(),
+            'severity': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+
+        if fields is not None:
+            entry.update(fields)
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    '''
+    Queues records for a background thread that passes them to the real
+    handler. The thread is started on first use in each process, so the
+    handler can be created before gunicorn forks its workers.
+    '''
+
+    def __init__(self, target_handler, max_queue_size):
+        '''
+        Args:
+            target_handler (obj): The logging.Handler that writes the records.
+            max_queue_size (int): The most records waiting to be written.
+        '''
+        super(AsyncLogHandler, self).__init__(queue.Queue(max_queue_size))
+        self._target_handler = target_handler
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        '''
+        Leaves formatting to the background thread. The arguments of
+        records logged by the bot are not changed after they are logged.
+        '''
+        return record
+
+    def enqueue(self, record):
+        '''
+        Queues a record without blocking, dropping it if the queue is full.
+        '''
+        self._ensure_started()
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            METRICS.increment('bm_log_records_dropped_total')
+
+    def close(self):
+        '''
+        Writes the records that are still queued, so the last lines logged
+        before the process exits are not lost.
+        '''
+        with self._lock:
+            if self._pid == os.getpid():
+                self._listener.stop()
+                self._listener = None
+                self._pid = None
+
+        super(AsyncLogHandler, self).close()
+
+    def _ensure_started(self):
+        '''
+        Starts the background thread if this process does not have one yet.
+        '''
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._listener = logging.handlers.QueueListener(
+                    self.queue, self._target_handler, respect_handler_level=True)
+                self._listener.start()
+                self._pid = os.getpid()
+
+def start_request():
+    '''
+    Starts timing the request handled by the calling thread.
+    '''
+    _local.start_time = _local.lap_time = time.perf_counter()
+    _local.stages = {}
+
+def lap(stage):
+    '''
+    Records the time since the previous lap as the duration of a stage.
+    Does nothing on threads that are not handling a request.
+
+    Args:
+        stage (str): The name of the stage that just finished.
+    '''
+    stages = getattr(_local, 'stages', None)
+
+    if stages is not None:
+        now = time.perf_counter()
+        stages[stage] = round((now - _local.lap_time) * 1000, 3)
+        _local.lap_time = now
+
+def finish_request():
+    '''
+    Stops timing the request handled by the calling thread.
+
+    Returns:
+       A :tuple: The total duration in milliseconds and a dict of the
+       duration of each stage, or (None, None) if the request was not timed.
+    '''
+    stages = getattr(_local, 'stages', None)
+
+    if stages is None:
+        return None, None
+
+    _local.stages = None
+
+    return round((time.perf_counter() - _local.start_time) * 1000, 3), stages
@@ -0,0 +1,282 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Retries and a circuit breaker for outbound API calls.
+
+RetryPolicy retries transient failures with capped exponential backoff and
+full jitter. Retries are paid for from a RetryBudget that only refills as
+new calls are made, so when most calls fail the retries stop instead of
+multiplying the load on the API.
+
+CircuitBreaker opens after several transient failures in a row and then
+fails calls straight away, until a single trial call after a cool-down
+shows the API is healthy again.
+"""
+
+import random
+import threading
+import time
+
+from metrics import METRICS
+
+# The circuit breaker states, with the values reported by the gauge
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_HALF_OPEN = 'half_open'
+CIRCUIT_OPEN = 'open'
+_CIRCUIT_STATE_VALUES = {CIRCUIT_CLOSED: 0, CIRCUIT_HALF_OPEN: 1, CIRCUIT_OPEN: 2}
+
+class CircuitOpenError(Exception):
+    '''
+    Raised instead of making a call while the circuit breaker is open.
+    '''
+
+class CircuitBreaker(object):
+    '''
+    Stops calls to an unhealthy API for a while.
+    '''
+
+    def __init__(self, failure_threshold, reset_timeout_seconds):
+        '''
+        Args:
+            failure_threshold (int): The transient failures in a row that
+                open the circuit.
+            reset_timeout_seconds (float): How long the circuit stays open
+                before a trial call is let through.
+        '''
+        self._failure_threshold = failure_threshold
+        self._reset_timeout_seconds = reset_timeout_seconds
+        self._lock = threading.Lock()
+        self._state = CIRCUIT_CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._trial_in_flight = False
+
+        METRICS.register_gauge('bm_circuit_state', lambda: _CIRCUIT_STATE_VALUES[self._state])
+
+    @property
+    def state(self):
+        '''
+        The current state, one of the CIRCUIT_* constants.
+        '''
+        return self._state
+
+    def allow(self):
+        '''
+        Decides whether a call may be made now. A call that is allowed must
+        be followed by record_success, record_failure or record_unknown.
+
+        Returns:
+           A :bool: True if the call may be made.
+        '''
+        with self._lock:
+            if self._state == CIRCUIT_CLOSED:
+                return True
+
+            if (self._state == CIRCUIT_OPEN
+                    and time.monotonic() - self._opened_at >= self._reset_timeout_seconds):
+                self._transition(CIRCUIT_HALF_OPEN)
+
+            if self._state == CIRCUIT_HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+
+            return False
+
+    def record_success(self):
+        '''
+        Records a call that reached the API, closing the circuit.
+        '''
+        with self._lock:
+            self._failures = 0
+            self._trial_in_flight = False
+
+            if self._state != CIRCUIT_CLOSED:
+                self._transition(CIRCUIT_CLOSED)
+
+    def record_failure(self):
+        '''
+        Records a transient failure, opening the circuit after too many.
+        '''
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+
+            if self._state == CIRCUIT_HALF_OPEN or self._failures >= self._failure_threshold:
+                self._opened_at = time.monotonic()
+
+                if self._state != CIRCUIT_OPEN:
+                    self._transition(CIRCUIT_OPEN)
+
+    def record_unknown(self):
+        '''
+        Records a call that failed without reaching the API, which says
+        nothing about its health, so another trial call may be made.
+        '''
+        with self._lock:
+            self._trial_in_flight = False
+
+    def _transition(self, state):
+        '''
+        Changes state. Must be called with the lock held.
+        '''
+        METRICS.increment('bm_circuit_transitions_total',
+                          labels={'from': self._state, 'to': state})
+        self._state = state
+
+class RetryBudget(object):
+    '''
+    Limits retries to a fraction of calls. Every call deposits a fraction
+    of a token and every retry withdraws a whole one.
+    '''
+
+    def __init__(self, ratio, max_tokens):
+        '''
+        Args:
+            ratio (float): The retries allowed per call, e.g. 0.2.
+            max_tokens (float): The most retries that can be saved up.
+        '''
+        self._ratio = ratio
+        self._max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        '''
+        Records a new call.
+        '''
+        with self._lock:
+            self._tokens = min(self._tokens + self._ratio, self._max_tokens)
+
+    def try_withdraw(self):
+        '''
+        Takes a token for a retry, if there is one.
+
+        Returns:
+           A :bool: True if the retry may go ahead.
+        '''
+        with self._lock:
+            if self._tokens < 1:
+                return False
+
+            self._tokens -= 1
+
+            return True
+
+class RetryPolicy(object):
+    '''
+    Makes calls through a circuit breaker, retrying transient failures.
+    '''
+
+    def __init__(self, max_attempts, base_delay_seconds, max_delay_seconds,
+                 budget, breaker, is_retryable, is_api_error):
+        '''
+        Args:
+            max_attempts (int): The most attempts at each call, including the first.
+            base_delay_seconds (float): The longest wait before the first retry.
+                It doubles for each later retry.
+            max_delay_seconds (float): The longest wait before any retry.
+            budget (obj): The RetryBudget retries are taken from.
+            breaker (obj): The CircuitBreaker guarding the API.
+            is_retryable (callable): Takes an exception and returns True if
+                it is a transient failure worth retrying.
+            is_api_error (callable): Takes an exception and returns True if
+                it is an error response from the API.
+        '''
+        self._max_attempts = max_attempts
+        self._base_delay_seconds = base_delay_seconds
+        self._max_delay_seconds = max_delay_seconds
+        self._budget = budget
+        self._breaker = breaker
+        self._is_retryable = is_retryable
+        self._is_api_error = is_api_error
+
+    def call(self, func, max_attempts=None):
+        '''
+        Calls func, retrying it while it fails with transient errors.
+
+        Args:
+            func (callable): Makes the call. Takes the attempt number,
+                starting at 1.
+            max_attempts (int): Overrides the policy's number of attempts.
+
+        Returns:
+           A :obj: The value returned by func.
+
+        Raises:
+            CircuitOpenError: If the circuit breaker is open.
+        '''
+        max_attempts = max_attempts or self._max_attempts
+        self._budget.deposit()
+
+        for attempt in range(1, max_attempts + 1):
+            if not self._breaker.allow():
+                METRICS.increment('bm_circuit_rejected_calls_total')
+                raise CircuitOpenError('The Business Messages API is unavailable')
+
+            try:
+                result = func(attempt)
+            except Exception as error:  # pylint: disable=broad-except
+                if not self._is_retryable(error):
+                    if self._is_api_error(error):
+                        # The API answered, so it is healthy
+                        self._breaker.record_success()
+                    else:
+                        # The call failed before it reached the API
+                        self._breaker.record_unknown()
+                    raise
+
+                self._breaker.record_failure()
+
+                if attempt == max_attempts or not self._budget.try_withdraw():
+                    raise
+
+                METRICS.increment('bm_api_retries_total')
+                time.sleep(self._get_delay(attempt, error))
+            else:
+                self._breaker.record_success()
+
+                return result
+
+    def _get_delay(self, attempt, error):
+        '''
+        Picks how long to wait before a retry: a random time up to the
+        exponential backoff, or longer if the API asked for it.
+        '''
+        backoff = min(self._base_delay_seconds * 2 ** (attempt - 1), self._max_delay_seconds)
+        delay = random.uniform(0, backoff)
+
+        retry_after = _get_retry_after(error)
+
+        if retry_after:
+            delay = max(delay, min(retry_after, self._max_delay_seconds))
+
+        return delay
+
+def _get_retry_after(error):
+    '''
+    Returns the seconds an error response asked to wait in its Retry-After
+    header, or None if it did not give a number of seconds.
+    '''
+    # apitools keeps the response headers in a dict, lower-cased unless the
+    # response was a part of a batch
+    headers = getattr(error, 'response', None) or {}
+
+    for name, value in headers.items():
+        if name.lower() == 'retry-after':
+            try:
+                return float(value)
+            except ValueError:
+                return None
+
+    return None
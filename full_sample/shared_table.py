@@ -0,0 +1,233 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A fixed-size hash table in shared memory, used by every gunicorn worker.
+
+The table lives in a memory-mapped file, so all worker processes on an
+instance see the same entries no matter which of them a webhook lands on.
+Each slot holds a 64-bit key hash, an expiry time and a 64-bit counter.
+Expired slots are free to be reused, so the table never needs cleaning.
+
+The slots are split into stripes, each an independent open addressing
+table with its own lock, so processes only contend when they touch keys
+in the same stripe. A stripe is locked with a byte-range fcntl lock,
+which excludes other processes, plus a threading lock, which excludes
+other threads of the same process.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Key hash, expiry time and counter
+_SLOT = struct.Struct('<Qdq')
+
+# Key hash marking a slot that has never been used
+_EMPTY = 0
+
+class SharedTable(object):
+    '''
+    A fixed-size table of expiring counters shared between processes.
+    '''
+
+    def __init__(self, path, num_slots, num_stripes=64, max_probes=16):
+        '''
+        Args:
+            path (str): The file backing the table. Every process sharing
+                the table must use the same path and sizes.
+            num_slots (int): The number of slots in the table.
+            num_stripes (int): The number of independently locked stripes.
+            max_probes (int): The most slots searched for a key.
+        '''
+        self._num_stripes = num_stripes
+        self._stripe_slots = max(num_slots // num_stripes, 1)
+        self._max_probes = min(max_probes, self._stripe_slots)
+        # The first page holds one lock byte per stripe
+        self._slots_offset = mmap.PAGESIZE
+        size = self._slots_offset + self._num_stripes * self._stripe_slots * _SLOT.size
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+
+        self._map = mmap.mmap(self._fd, size)
+        self._thread_locks = [threading.Lock() for _ in range(num_stripes)]
+
+    def add(self, key, ttl_seconds):
+        '''
+        Inserts a key unless it is already present and not expired.
+
+        Args:
+            key (str): The key to insert.
+            ttl_seconds (float): How long the key stays present.
+
+        Returns:
+           A :bool: True if the key was inserted, False if it was present.
+        '''
+        with self._locked(key) as (key_hash, stripe):
+            slot, found = self._find(key_hash, stripe, time.time())
+
+            if found:
+                return False
+
+            self._write(slot, key_hash, time.time() + ttl_seconds, 0)
+
+            return True
+
+    def increment(self, key, amount, ttl_seconds):
+        '''
+        Adds to the counter for a key, starting a new counter that expires
+        after ttl_seconds if the key is absent or expired.
+
+        Args:
+            key (str): The counter key.
+            amount (int): The amount to add.
+            ttl_seconds (float): The lifetime of a newly started counter.
+
+        Returns:
+           A :int: The new counter value.
+        '''
+        with self._locked(key) as (key_hash, stripe):
+            now = time.time()
+            slot, found = self._find(key_hash, stripe, now)
+
+            if found:
+                _, expiry, value = _SLOT.unpack_from(self._map, slot)
+                value += amount
+            else:
+                expiry, value = now + ttl_seconds, amount
+
+            self._write(slot, key_hash, expiry, value)
+
+            return value
+
+    def get(self, key):
+        '''
+        Returns the counter for a key.
+
+        Args:
+            key (str): The counter key.
+
+        Returns:
+           A :int: The counter value, or 0 if the key is absent or expired.
+        '''
+        with self._locked(key) as (key_hash, stripe):
+            slot, found = self._find(key_hash, stripe, time.time())
+
+            return _SLOT.unpack_from(self._map, slot)[2] if found else 0
+
+    def discard(self, key):
+        '''
+        Removes a key. Its slot is marked expired rather than empty, so that
+        searches for other keys keep probing past it.
+
+        Args:
+            key (str): The key to remove.
+        '''
+        with self._locked(key) as (key_hash, stripe):
+            slot, found = self._find(key_hash, stripe, time.time())
+
+            if found:
+                self._write(slot, key_hash, 0.0, 0)
+
+    @contextlib.contextmanager
+    def _locked(self, key):
+        '''
+        Holds the thread and process locks of the key's stripe, yielding the
+        key hash and stripe number.
+        '''
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+        key_hash = struct.unpack('<Q', digest)[0] or 1
+        stripe = key_hash % self._num_stripes
+
+        with self._thread_locks[stripe]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, stripe)
+
+            try:
+                yield key_hash, stripe
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe)
+
+    def _find(self, key_hash, stripe, now):
+        '''
+        Searches the stripe for a live slot holding the key.
+
+        Returns:
+           A :tuple: The offset of the key's slot and True if it was found,
+           otherwise the offset of the best slot to insert it and False.
+        '''
+        stripe_offset = self._slots_offset + stripe * self._stripe_slots * _SLOT.size
+        home = (key_hash // self._num_stripes) % self._stripe_slots
+        free_slot = None
+        oldest_slot, oldest_expiry = None, None
+
+        for probe in range(self._max_probes):
+            slot = stripe_offset + ((home + probe) % self._stripe_slots) * _SLOT.size
+            slot_hash, expiry, _ = _SLOT.unpack_from(self._map, slot)
+
+            if slot_hash == _EMPTY:
+                # Nothing was ever stored past an empty slot
+                return (free_slot if free_slot is not None else slot), False
+
+            if expiry <= now:
+                if free_slot is None:
+                    free_slot = slot
+            elif slot_hash == key_hash:
+                return slot, True
+            elif oldest_expiry is None or expiry < oldest_expiry:
+                oldest_slot, oldest_expiry = slot, expiry
+
+        # The probe window is full, so evict the entry closest to expiring
+        return (free_slot if free_slot is not None else oldest_slot), False
+
+    def _write(self, slot, key_hash, expiry, value):
+        '''
+        Writes a slot.
+        '''
+        _SLOT.pack_into(self._map, slot, key_hash, expiry, value)
+
+class SharedDedupStore(object):
+    '''
+    A dedup store (see dedup.py) backed by a SharedTable, so a redelivered
+    webhook is dropped whichever worker process receives it.
+    '''
+
+    def __init__(self, table, ttl_seconds):
+        '''
+        Args:
+            table (obj): The SharedTable to store keys in.
+            ttl_seconds (float): How long each key is remembered.
+        '''
+        self._table = table
+        self._ttl_seconds = ttl_seconds
+
+    def add(self, key):
+        '''
+        Records a key unless it was already seen.
+
+        Returns:
+           A :bool: False if the key was seen within the TTL, True otherwise.
+        '''
+        return self._table.add('dedup:' + key, self._ttl_seconds)
+
+    def discard(self, key):
+        '''
+        Forgets a key.
+        '''
+        self._table.discard('dedup:' + key)
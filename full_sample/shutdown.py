@@ -0,0 +1,172 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Graceful shutdown of a worker process.
+
+When the worker is told to stop with SIGTERM, it stops accepting webhooks
+and, before the process exits, waits a while for the replies that are
+being sent or are queued. Queued replies that are still waiting at the
+deadline are dropped, and every conversation whose reply is still being
+sent gets a typing stopped event, so no user is left looking at a typing
+indicator for a reply that will never come. When the outbox is on, the
+replies that were dropped or abandoned are sent by another worker once the
+lease of the stopped one runs out.
+
+gunicorn sets up its own signal handlers before it loads the app, so the
+handler installed here passes SIGTERM on to gunicorn's, and the waiting
+is done at exit, once gunicorn has finished the requests in progress.
+"""
+
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import logging
+import signal
+import threading
+import time
+
+from metrics import METRICS
+
+# How often the drain checks whether the sends have finished
+_POLL_INTERVAL_SECONDS = 0.05
+
+# The most typing stopped events sent at once after the deadline
+_MAX_STOP_TYPING_THREADS = 8
+
+class ShutdownCoordinator(object):
+    '''
+    Tracks the replies being sent and drains them when the worker stops.
+    '''
+
+    def __init__(self, drain_timeout_seconds, send_pool, stop_typing):
+        '''
+        Args:
+            drain_timeout_seconds (float): The longest to wait for replies
+                that are being sent or are queued.
+            send_pool (obj): The SendWorkerPool whose queued replies are waited for.
+            stop_typing (callable): Sends a typing stopped event. Takes the
+                conversation id.
+        '''
+        self._drain_timeout_seconds = drain_timeout_seconds
+        self._send_pool = send_pool
+        self._stop_typing = stop_typing
+        self._lock = threading.Lock()
+        self._sending = collections.Counter()
+        self._draining = False
+        self._drained = False
+        self._previous_handler = None
+
+    @property
+    def draining(self):
+        '''
+        Whether the worker is stopping and should not accept webhooks.
+        '''
+        return self._draining
+
+    def install(self):
+        '''
+        Handles SIGTERM and drains the sends when the process exits. The
+        signal handler can only be installed from the main thread.
+        '''
+        if threading.current_thread() is threading.main_thread():
+            self._previous_handler = signal.signal(signal.SIGTERM, self._handle_sigterm)
+
+        atexit.register(self.drain)
+
+    @contextlib.contextmanager
+    def sending(self, conversation_id):
+        '''
+        Returns a context manager that marks a reply to a conversation as
+        being sent while its block runs.
+
+        Args:
+            conversation_id (str): The unique id for this user and agent.
+        '''
+        with self._lock:
+            self._sending[conversation_id] += 1
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._sending[conversation_id] -= 1
+
+                if not self._sending[conversation_id]:
+                    del self._sending[conversation_id]
+
+    def drain(self):
+        '''
+        Stops accepting webhooks, waits for the replies being sent and
+        queued until the deadline, then drops the queued replies that are
+        left and stops the typing indicator of the replies still being sent.
+        Only the first call does anything.
+        '''
+        with self._lock:
+            if self._drained:
+                return
+
+            self._draining = self._drained = True
+
+        start_time = time.monotonic()
+        deadline = start_time + self._drain_timeout_seconds
+        pending = self._send_pool.queued() + sum(self._sending.values())
+
+        while time.monotonic() < deadline and (self._send_pool.pending() or self._sending):
+            time.sleep(_POLL_INTERVAL_SECONDS)
+
+        dropped = self._send_pool.discard_queued()
+
+        with self._lock:
+            abandoned = sum(self._sending.values())
+            abandoned_conversation_ids = list(self._sending)
+
+        if abandoned_conversation_ids:
+            # Stop the typing indicators in parallel, as the deadline has passed
+            with concurrent.futures.ThreadPoolExecutor(
+                    min(len(abandoned_conversation_ids), _MAX_STOP_TYPING_THREADS)) as executor:
+                executor.map(self._stop_typing_safely, abandoned_conversation_ids)
+
+        drained = max(pending - dropped - abandoned, 0)
+        METRICS.increment('bm_shutdown_replies_total', drained, labels={'outcome': 'drained'})
+        METRICS.increment('bm_shutdown_replies_total', dropped, labels={'outcome': 'dropped'})
+        METRICS.increment('bm_shutdown_replies_total', abandoned, labels={'outcome': 'abandoned'})
+        logging.getLogger(__name__).log(
+            logging.WARNING if dropped or abandoned else logging.INFO,
+            'Shutdown drain took %.3fs: %d replies drained, %d queued replies dropped, '
+            '%d replies abandoned while being sent', time.monotonic() - start_time,
+            drained, dropped, abandoned)
+
+    def _stop_typing_safely(self, conversation_id):
+        '''
+        Sends a typing stopped event, logging any failure.
+        '''
+        try:
+            self._stop_typing(conversation_id)
+        except Exception:  # pylint: disable=broad-except
+            logging.getLogger(__name__).warning(
+                'Failed to stop the typing indicator of %s', conversation_id, exc_info=True)
+
+    def _handle_sigterm(self, signum, frame):
+        '''
+        Stops accepting webhooks and lets the previous handler stop the
+        server, or drains and exits if there was none.
+        '''
+        self._draining = True
+
+        if callable(self._previous_handler):
+            self._previous_handler(signum, frame)
+        elif self._previous_handler == signal.SIG_DFL:
+            self.drain()
+            raise SystemExit(128 + signum)
@@ -0,0 +1,227 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests the asyncio client and the ASGI app against a local stub of the
+Business Messages API.
+
+Run with: python -m pytest test_async_client.py
+"""
+
+import base64
+import hashlib
+import hmac
+import http.server
+import json
+import threading
+import unittest
+import urllib.parse
+import uuid
+from unittest import mock
+
+from apitools.base.py import exceptions as apitools_exceptions
+
+from businessmessages import businessmessages_v1_client as bm_client
+
+from async_client import AsyncBusinessMessagesClient
+from middleware import SignatureVerifier
+
+import asgi
+import main
+
+# The access token sent by the tests, and the key webhooks are signed with
+ACCESS_TOKEN = 'test-token'
+PARTNER_KEY = 'test-partner-key'
+
+class _StubHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Records every POST and answers it with its own body, or with the status
+    the test asked for.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers.get('content-length') or 0))
+        url = urllib.parse.urlsplit(self.path)
+        self.server.requests.append({
+            'path': url.path,
+            'query': urllib.parse.parse_qs(url.query),
+            'authorization': self.headers.get('authorization'),
+            'body': json.loads(body),
+        })
+
+        status = self.server.status
+        response_body = body if status == 200 else b'{"error": {"code": %d}}' % status
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+async def get_access_token():
+    return ACCESS_TOKEN
+
+def message_body(conversation_id, text):
+    '''
+    Encodes a message webhook with a new message id, so it is never dropped
+    as a redelivery.
+    '''
+    return json.dumps({'conversationId': conversation_id,
+                       'message': {'messageId': uuid.uuid4().hex, 'text': text}}).encode('utf-8')
+
+class AsyncClientTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.server.status = 200
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        base_url_patch = mock.patch.object(
+            bm_client.BusinessmessagesV1, 'BASE_URL',
+            'http://127.0.0.1:%d/' % self.server.server_address[1])
+        base_url_patch.start()
+        self.addCleanup(base_url_patch.stop)
+
+    async def asyncSetUp(self):
+        self.client = AsyncBusinessMessagesClient(get_access_token, 10, 10)
+        await self.client.start()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def assert_reply_sent(self, conversation_id, check_message):
+        '''
+        Checks that the stub received a message wrapped in typing events.
+        '''
+        requests = self.server.requests
+        self.assertEqual([request['path'] for request in requests], [
+            '/v1/conversations/%s/events' % conversation_id,
+            '/v1/conversations/%s/messages' % conversation_id,
+            '/v1/conversations/%s/events' % conversation_id,
+        ])
+        self.assertEqual([requests[0]['body']['eventType'], requests[2]['body']['eventType']],
+                         ['TYPING_STARTED', 'TYPING_STOPPED'])
+        self.assertIn('eventId', requests[0]['query'])
+        self.assertEqual({request['authorization'] for request in requests},
+                         {'Bearer ' + ACCESS_TOKEN})
+        check_message(requests[1]['body'])
+
+    async def test_send_message(self):
+        await self.client.send_message(
+            main.build_echo_message('hello'), 'conversation-1', main.BOT_REPRESENTATIVE)
+
+        self.assert_reply_sent('conversation-1', lambda message: (
+            self.assertEqual(message['text'], 'hello')))
+
+    async def test_send_encoded_message(self):
+        message = main.REPLY_TEMPLATES.get(main.CMD_RICH_CARD)
+
+        await self.client.send_message(
+            main.REPLY_TEMPLATES.encode(message), 'conversation-1', main.BOT_REPRESENTATIVE)
+
+        self.assert_reply_sent('conversation-1', lambda body: (
+            self.assertEqual(body['messageId'], message.messageId),
+            self.assertIn('richCard', body)))
+
+    async def test_error_response_raises_http_error(self):
+        self.server.status = 404
+
+        with self.assertRaises(apitools_exceptions.HttpNotFoundError):
+            await self.client.create_message(main.build_echo_message('hello'), 'conversation-1')
+
+    async def call_app(self, body, signature=None):
+        '''
+        Posts a webhook to the ASGI app, returning the status and body.
+        '''
+        messages = []
+        headers = [(b'x-goog-signature', signature.encode('ascii'))] if signature else []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        with mock.patch.object(asgi, 'ASYNC_CLIENT', self.client):
+            await asgi.app({'type': 'http', 'path': '/callback', 'method': 'POST',
+                            'headers': headers}, receive, send)
+
+        return messages[0]['status'], messages[1]['body']
+
+    async def test_app_replies_to_message(self):
+        body = message_body('conversation-2', 'chips')
+
+        self.assertEqual(await self.call_app(body), (200, b''))
+        self.assert_reply_sent('conversation-2', lambda message: (
+            self.assertIn('suggestions', message)))
+
+    async def test_app_drops_redelivered_webhook(self):
+        body = message_body('conversation-4', 'hi')
+
+        self.assertEqual(await self.call_app(body), (200, b''))
+        self.assertEqual(await self.call_app(body), (200, b''))
+        self.assertEqual(len(self.server.requests), 3)
+
+    async def test_app_redelivery_after_failure_is_processed(self):
+        body = message_body('conversation-5', 'hi')
+        self.server.status = 500
+
+        with self.assertRaises(apitools_exceptions.HttpError):
+            await self.call_app(body)
+
+        self.server.status = 200
+        self.assertEqual(await self.call_app(body), (200, b''))
+
+    async def test_app_sheds_webhooks_while_draining(self):
+        with mock.patch.object(main.SHUTDOWN, '_draining', True):
+            self.assertEqual(await self.call_app(b'{"secret": "abc"}'), (503, b''))
+
+    async def test_app_returns_secret(self):
+        self.assertEqual(await self.call_app(b'{"secret": "abc"}'), (200, b'abc'))
+        self.assertEqual(self.server.requests, [])
+
+    async def test_app_rejects_invalid_body(self):
+        for body in (b'{"message": "hi"}',
+                     b'{"message": {"messageId": "m", "text": "hi"}}',
+                     b'{"suggestionResponse": {"text": "hi"}}'):
+            with self.subTest(body=body):
+                status, _ = await self.call_app(body)
+
+                self.assertEqual(status, 400)
+
+        self.assertEqual(self.server.requests, [])
+
+    async def test_app_checks_signatures(self):
+        body = message_body('conversation-3', 'hi')
+        signature = base64.b64encode(hmac.new(
+            PARTNER_KEY.encode('utf-8'), body, hashlib.sha512).digest()).decode('ascii')
+
+        with mock.patch.object(main, 'SIGNATURE_VERIFIER', SignatureVerifier([PARTNER_KEY])):
+            self.assertEqual(await self.call_app(body), (403, b''))
+            self.assertEqual(await self.call_app(body, 'invalid'), (403, b''))
+            self.assertEqual(await self.call_app(body, signature), (200, b''))
+
+        self.assertEqual(len(self.server.requests), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests that the cached JSON encoding of each reply template matches the
+protorpc encoder byte for byte.
+
+Run with: python -m pytest test_templates.py
+"""
+
+import unittest
+
+from apitools.base.py import encoding
+
+import main
+
+class ReplyTemplatesTest(unittest.TestCase):
+
+    def test_cached_encoding_matches_encoder(self):
+        for name in (main.CMD_RICH_CARD, main.CMD_CAROUSEL_CARD, main.CMD_SUGGESTIONS):
+            with self.subTest(template=name):
+                message = main.REPLY_TEMPLATES.get(name)
+                encoded_message = main.REPLY_TEMPLATES.encode(message)
+
+                self.assertIsNotNone(encoded_message)
+                self.assertEqual(encoded_message,
+                                 encoding.MessageToJson(message).encode('utf-8'))
+
+    def test_modified_copy_is_not_cached(self):
+        message = main.REPLY_TEMPLATES.get(main.CMD_SUGGESTIONS)
+        message.text = 'Something else'
+
+        self.assertIsNone(main.REPLY_TEMPLATES.encode(message))
+
+    def test_copies_get_new_message_ids(self):
+        first = main.REPLY_TEMPLATES.get(main.CMD_RICH_CARD)
+        second = main.REPLY_TEMPLATES.get(main.CMD_RICH_CARD)
+
+        self.assertNotEqual(first.messageId, second.messageId)
+        self.assertNotEqual(main.REPLY_TEMPLATES.encode(first),
+                            main.REPLY_TEMPLATES.encode(second))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# Copyright 2020 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests the pooled transport against a local stub server that counts the
+TCP connections it accepts.
+
+Run with: python -m pytest test_transport.py
+"""
+
+import concurrent.futures
+import http.server
+import socket
+import threading
+import unittest
+
+import httplib2
+
+from transport import HttpConnectionPool, PooledHttp
+
+# The messages sent in each test, each costing three API calls like a reply
+NUM_MESSAGES = 1000
+
+# Threads sending messages at once, and connections the pool may open
+NUM_THREADS = 8
+POOL_SIZE = 4
+
+class _StubHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Answers every POST with an empty JSON object over a keep-alive connection.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        with self.server.lock:
+            self.server.connections += 1
+
+        super(_StubHandler, self).setup()
+        # Send each small response without waiting for a delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self.rfile.read(int(self.headers.get('content-length') or 0))
+        self.send_response(200)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+class TransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.connections = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def send_messages(self, get_http):
+        '''
+        Sends the typing started event, message and typing stopped event of
+        every message from several threads, and returns the connections
+        the stub server accepted.
+        '''
+        def send_message(i):
+            http = get_http()
+
+            for path in ('events', 'messages', 'events'):
+                response, _ = http.request(self.url + path, method='POST', body='{"n": %d}' % i,
+                                           headers={'content-type': 'application/json'})
+                self.assertEqual(response.status, 200)
+
+        with concurrent.futures.ThreadPoolExecutor(NUM_THREADS) as executor:
+            list(executor.map(send_message, range(NUM_MESSAGES)))
+
+        return self.server.connections
+
+    def test_pool_reuses_connections(self):
+        pool = HttpConnectionPool(POOL_SIZE, timeout=10)
+
+        connections = self.send_messages(lambda: PooledHttp(pool))
+
+        print('pooled: %d connections per %d messages' % (connections, NUM_MESSAGES))
+        self.assertLessEqual(connections, POOL_SIZE)
+
+    def test_unpooled_transport_connects_per_message(self):
+        # The default transport, a new httplib2.Http per message, for comparison
+        connections = self.send_messages(lambda: httplib2.Http(timeout=10))
+
+        print('unpooled: %d connections per %d messages' % (connections, NUM_MESSAGES))
+        self.assertGreaterEqual(connections, NUM_MESSAGES)
+
+if __name__ == '__main__':
+    unittest.main()
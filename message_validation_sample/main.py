@@ -26,12 +26,17 @@ Any other incoming message is echoed back to the end-user.
 # [START app]
 import json
 import hmac
+import os
+import threading
 import uuid
 import base64
+import binascii
 import hashlib
 
 from oauth2client.service_account import ServiceAccountCredentials
 
+from apitools.base.py import exceptions as apitools_exceptions
+
 from flask import Flask
 from flask import request
 
@@ -47,6 +52,17 @@ from businessmessages.businessmessages_v1_messages import (
 # The location of the service account credentials
 SERVICE_ACCOUNT_LOCATION = 'resources/bm-agent-service-account-credentials.json'
 
+# The OAuth scope required to call the Business Messages API
+BM_API_SCOPES = ['https://www.googleapis.com/auth/businessmessages']
+
+# The partner keys that webhooks may be signed with. To rotate the key, add
+# the new one here before removing the old one.
+PARTNER_KEYS = ['YOUR_PARTNER_KEY']
+
+# The longest unsigned body read; only webhook verification requests, which
+# are a few dozen bytes, are sent unsigned
+UNSIGNED_MAX_BYTES = 1024
+
 # Set of commands the bot understands
 CMD_RICH_CARD = 'card'
 CMD_CAROUSEL_CARD = 'carousel'
@@ -67,6 +83,116 @@ BOT_REPRESENTATIVE = BusinessMessagesRepresentative(
     displayName='Echo Bot',
     avatarImage='https://storage.googleapis.com/sample-avatars-for-bm/bot-avatar.jpg')
 
+class ClientCache(object):
+    '''
+    Caches the service account credentials and Business Messages client so
+    they are built once per worker instead of once per message.
+
+    The credentials, and the OAuth access token they hold, are shared by all
+    threads and only reloaded when the credentials file changes or after an
+    authorization failure. Each thread gets its own client because the
+    httplib2 transport underneath it is not thread-safe.
+    '''
+
+    def __init__(self, credentials_location):
+        self._credentials_location = credentials_location
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._credentials_mtime = None
+        self._generation = 0
+        self._local = threading.local()
+
+    def get_credentials(self):
+        '''
+        Returns the cached credentials, loading them from disk on first use
+        or when the credentials file has been modified.
+
+        Returns:
+           A :tuple: The ServiceAccountCredentials and their generation number.
+        '''
+        mtime = os.stat(self._credentials_location).st_mtime
+
+        with self._lock:
+            if self._credentials is None or mtime != self._credentials_mtime:
+                self._credentials = ServiceAccountCredentials.from_json_keyfile_name(
+                    self._credentials_location, scopes=BM_API_SCOPES)
+                self._credentials_mtime = mtime
+                self._generation += 1
+
+            return self._credentials, self._generation
+
+    def get_client(self):
+        '''
+        Returns the Business Messages client for the calling thread.
+
+        Returns:
+           A :obj: A BusinessmessagesV1 client.
+        '''
+        credentials, generation = self.get_credentials()
+
+        if getattr(self._local, 'generation', None) != generation:
+            self._local.client = bm_client.BusinessmessagesV1(credentials=credentials)
+            self._local.generation = generation
+
+        return self._local.client
+
+    def invalidate(self):
+        '''
+        Drops the cached credentials so they are reloaded on next use.
+        '''
+        with self._lock:
+            self._credentials = None
+
+# The credentials and clients shared by every request in this worker
+CLIENT_CACHE = ClientCache(SERVICE_ACCOUNT_LOCATION)
+
+class SignatureVerifier(object):
+    '''
+    Checks the x-goog-signature of webhooks, an HMAC-SHA512 of the request
+    body keyed with the partner key.
+
+    The keys are hashed into HMAC objects once, and each request copies
+    them instead of starting from the raw key again.
+    '''
+
+    def __init__(self, partner_keys):
+        '''
+        Args:
+            partner_keys (list): The partner keys that webhooks may be signed with.
+        '''
+        self._prepared_macs = [
+            hmac.new(partner_key.encode('utf-8'), digestmod=hashlib.sha512)
+            for partner_key in partner_keys]
+
+    def verify(self, body, signature):
+        '''
+        Checks a signature against every partner key in constant time.
+
+        Args:
+            body (bytes): The raw request body.
+            signature (str): The base64 encoded x-goog-signature header.
+
+        Returns:
+           A :bool: True if the body was signed with one of the partner keys.
+        '''
+        try:
+            expected_digest = base64.b64decode(signature, validate=True)
+        except (binascii.Error, ValueError):
+            return False
+
+        valid = False
+
+        # Check every key, so the time taken does not reveal which one matched
+        for prepared_mac in self._prepared_macs:
+            mac = prepared_mac.copy()
+            mac.update(body)
+            valid |= hmac.compare_digest(mac.digest(), expected_digest)
+
+        return valid
+
+# Verifies that webhooks come from Google
+SIGNATURE_VERIFIER = SignatureVerifier(PARTNER_KEYS)
+
 app = Flask(__name__, static_url_path='')
 app.config['DEBUG'] = True
 
@@ -75,30 +201,42 @@ def callback():
     """
     Callback URL. Processes messages sent from user.
     """
-    request_body = request.json
-    app.logger.debug(request_body)
-
-    # To set a webhook, extract the secret from the request and return it
-    if 'secret' in request_body:
-        return request_body.get('secret')
-
-    # Calculate the signature to validate the message is from Google
-    partner_key = 'YOUR_PARTNER_KEY'
-    generated_signature = base64.b64encode(hmac.new(partner_key.encode(), msg=request.get_data(), digestmod=hashlib.sha512).digest()).decode('UTF-8')
     # Grab the x-goog-signature from the request header
     google_signature = request.headers.get('x-goog-signature')
-
     app.logger.debug('x-goog-signature: %s', google_signature)
-    app.logger.debug('Generated Signature: %s', generated_signature)
 
-    # Compare x-goog-signature with locally generated signature
-    if generated_signature == google_signature:
-        app.logger.debug("Signature match.")
-    else:
-        app.logger.debug("Signature mismatch, do not trust this message.")
+    if google_signature is None:
+        # Only the webhook verification request is sent unsigned. To set a
+        # webhook, extract the secret from the request and return it.
+        # Read one byte past the limit to tell a body that is too large.
+        raw_body = request.stream.read(UNSIGNED_MAX_BYTES + 1)
+
+        try:
+            request_body = (json.loads(raw_body) if len(raw_body) <= UNSIGNED_MAX_BYTES
+                            else None)
+        except ValueError:
+            request_body = None
+
+        if isinstance(request_body, dict) and 'secret' in request_body:
+            return request_body.get('secret')
+
+        app.logger.warning('Rejecting an unsigned message')
+        return 'Missing signature', 403
+
+    # Reject messages that are not from Google before doing any work on them
+    if not SIGNATURE_VERIFIER.verify(request.get_data(), google_signature):
+        app.logger.warning('Signature mismatch, rejecting the message')
+        return 'Invalid signature', 403
+
+    app.logger.debug('Signature match.')
 
+    request_body = request.get_json(force=True)
     app.logger.debug('request_body: %s', json.dumps(request_body))
 
+    # To set a webhook, extract the secret from the request and return it
+    if 'secret' in request_body:
+        return request_body.get('secret')
+
     # Extract the conversation id and message text
     conversation_id = request_body['conversationId']
     app.logger.debug('conversation_id: %s', conversation_id)
@@ -239,12 +377,25 @@ def send_message(message, conversation_id):
         message (obj): The message object payload to send to the user.
         conversation_id (str): The unique id for this user and agent.
     '''
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        SERVICE_ACCOUNT_LOCATION,
-        scopes=['https://www.googleapis.com/auth/businessmessages'])
+    client = CLIENT_CACHE.get_client()
+
+    try:
+        send_typing_and_message(client, message, conversation_id)
+    except apitools_exceptions.HttpUnauthorizedError:
+        # The cached key may have been revoked or rotated, reload it next time
+        CLIENT_CACHE.invalidate()
+        raise
 
-    client = bm_client.BusinessmessagesV1(credentials=credentials)
+def send_typing_and_message(client, message, conversation_id):
+    '''
+    Sends the typing started event, the message and the typing stopped
+    event using the given Business Messages client.
 
+    Args:
+        client (obj): The BusinessmessagesV1 client to send with.
+        message (obj): The message object payload to send to the user.
+        conversation_id (str): The unique id for this user and agent.
+    '''
     # Send the typing started event
     create_request = BusinessmessagesConversationsEventsCreateRequest(
         eventId=str(uuid.uuid4().int),
@@ -26,10 +26,14 @@ Any other incoming message is echoed back to the end-user.
 
 # [START app]
 import json
+import os
+import threading
 import uuid
 
 from oauth2client.service_account import ServiceAccountCredentials
 
+from apitools.base.py import exceptions as apitools_exceptions
+
 from flask import Flask
 from flask import request
 
@@ -45,6 +49,9 @@ from businessmessages.businessmessages_v1_messages import (
 # The location of the service account credentials
 SERVICE_ACCOUNT_LOCATION = 'resources/bm-agent-service-account-credentials.json'
 
+# The OAuth scope required to call the Business Messages API
+BM_API_SCOPES = ['https://www.googleapis.com/auth/businessmessages']
+
 # Set of commands the bot understands
 CMD_RICH_CARD = 'card'
 CMD_CAROUSEL_CARD = 'carousel'
@@ -65,6 +72,69 @@ BOT_REPRESENTATIVE = BusinessMessagesRepresentative(
     displayName='Echo Bot',
     avatarImage='https://storage.googleapis.com/sample-avatars-for-bm/bot-avatar.jpg')
 
+class ClientCache(object):
+    '''
+    Caches the service account credentials and Business Messages client so
+    they are built once per worker instead of once per message.
+
+    The credentials, and the OAuth access token they hold, are shared by all
+    threads and only reloaded when the credentials file changes or after an
+    authorization failure. Each thread gets its own client because the
+    httplib2 transport underneath it is not thread-safe.
+    '''
+
+    def __init__(self, credentials_location):
+        self._credentials_location = credentials_location
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._credentials_mtime = None
+        self._generation = 0
+        self._local = threading.local()
+
+    def get_credentials(self):
+        '''
+        Returns the cached credentials, loading them from disk on first use
+        or when the credentials file has been modified.
+
+        Returns:
+           A :tuple: The ServiceAccountCredentials and their generation number.
+        '''
+        mtime = os.stat(self._credentials_location).st_mtime
+
+        with self._lock:
+            if self._credentials is None or mtime != self._credentials_mtime:
+                self._credentials = ServiceAccountCredentials.from_json_keyfile_name(
+                    self._credentials_location, scopes=BM_API_SCOPES)
+                self._credentials_mtime = mtime
+                self._generation += 1
+
+            return self._credentials, self._generation
+
+    def get_client(self):
+        '''
+        Returns the Business Messages client for the calling thread.
+
+        Returns:
+           A :obj: A BusinessmessagesV1 client.
+        '''
+        credentials, generation = self.get_credentials()
+
+        if getattr(self._local, 'generation', None) != generation:
+            self._local.client = bm_client.BusinessmessagesV1(credentials=credentials)
+            self._local.generation = generation
+
+        return self._local.client
+
+    def invalidate(self):
+        '''
+        Drops the cached credentials so they are reloaded on next use.
+        '''
+        with self._lock:
+            self._credentials = None
+
+# The credentials and clients shared by every request in this worker
+CLIENT_CACHE = ClientCache(SERVICE_ACCOUNT_LOCATION)
+
 app = Flask(__name__, static_url_path='')
 app.config['DEBUG'] = True
 
@@ -184,12 +254,25 @@ def send_message(message, conversation_id):
         message (obj): The message object payload to send to the user.
         conversation_id (str): The unique id for this user and agent.
     '''
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        SERVICE_ACCOUNT_LOCATION,
-        scopes=['https://www.googleapis.com/auth/businessmessages'])
+    client = CLIENT_CACHE.get_client()
 
-    client = bm_client.BusinessmessagesV1(credentials=credentials)
+    try:
+        send_typing_and_message(client, message, conversation_id)
+    except apitools_exceptions.HttpUnauthorizedError:
+        # The cached key may have been revoked or rotated, reload it next time
+        CLIENT_CACHE.invalidate()
+        raise
 
+def send_typing_and_message(client, message, conversation_id):
+    '''
+    Sends the typing started event, the message and the typing stopped
+    event using the given Business Messages client.
+
+    Args:
+        client (obj): The BusinessmessagesV1 client to send with.
+        message (obj): The message object payload to send to the user.
+        conversation_id (str): The unique id for this user and agent.
+    '''
     # Send the typing started event
     create_request = BusinessmessagesConversationsEventsCreateRequest(
         eventId=str(uuid.uuid4().int),